@@ -0,0 +1,483 @@
+"""記録済みのページを使ったオフラインのベンチマークです。
+
+eBay・Google画像検索（Google レンズ）・Amazon・ERESAのページを再現するローカルHTTPサーバーと、
+Google Sheets APIを再現するフェイクのサービスを使い、実際のサイトやAPIの利用枠を使わずに処理速度を計測します。
+
+    python benchmarks/benchmark.py                # すべてのベンチマークを実行
+    python benchmarks/benchmark.py --no-browser   # Chromeを使わないベンチマークのみ実行
+"""
+import os
+import re
+import sys
+import json
+import time
+import logging
+import argparse
+import functools
+import threading
+import importlib.util
+from html.parser import HTMLParser
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_DIR = os.path.join(BENCHMARK_DIR, 'fixtures')
+THRESHOLDS_FILE = os.path.join(BENCHMARK_DIR, 'thresholds.json')
+SCRIPT_PATH = os.path.join(os.path.dirname(BENCHMARK_DIR), 'get-jan-from-eresa-on-amazon.py')
+
+SHEET_NAME = 'Benchmark'
+EBAY_LINK_COLUMN = 'C'
+JAN_CODE_COLUMN = 'D'
+IMAGE_URL_COLUMN = 'F'
+ASIN_COLUMN = 'E'
+AMAZON_URL_COLUMN = 'G'
+
+
+def load_tool():
+    """ファイル名にハイフンを含むツール本体をモジュールとして読み込みます。"""
+    spec = importlib.util.spec_from_file_location('get_jan_from_eresa_on_amazon', SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURE_DIR, name), 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def render(template, **values):
+    """テンプレート内の {{NAME}} を値で置き換えます。"""
+    for name, value in values.items():
+        template = template.replace('{{' + name + '}}', str(value))
+    return template
+
+
+def jan_check_digit(digits):
+    """JAN（EAN-13）の先頭12桁からチェックデジットを計算します。"""
+    total = sum(int(digit) * (3 if index % 2 else 1) for index, digit in enumerate(digits))
+    return str((10 - total % 10) % 10)
+
+
+def item_image_url(item_id):
+    return f'https://i.ebayimg.com/images/g/BENCH{item_id}/s-l1600.jpg'
+
+
+def item_asin(item_id):
+    return f'B0{item_id:08d}'
+
+
+def item_jan(item_id):
+    digits = f'49{item_id:010d}'
+    return digits + jan_check_digit(digits)
+
+
+def padding(size_kb):
+    """実際の商品ページと同程度の大きさにするための、意味のないマークアップを返します。"""
+    block = ('<div class="x-filler"><span class="ux-textspans">Lorem ipsum dolor sit amet, '
+             'consectetur adipiscing elit.</span><a href="https://www.ebay.com/">link</a></div>\n')
+    return block * max(0, size_kb * 1024 // len(block))
+
+
+class FixtureServer:
+    """eBay・Google画像検索・Amazon・ERESAのページを再現するローカルHTTPサーバーです。
+
+    - /ebay/itm/<商品番号>: eBayの商品ページ（偶数番号のみ商品の詳細にJANコードあり）
+    - /ebay/redirect/<商品番号>: eBayのリダイレクトページ
+    - /images: Google画像検索のトップページ
+    - /lens/results: Google レンズの検索結果ページ（tab=productsで商品タブ）
+    - /amazon.co.jp/dp/<ASIN>: Amazonの商品ページ（ERESAのiframe付き）
+    - /eresa/chart: ERESAのiframeの中身
+    """
+
+    def __init__(self, latency=0.0, ebay_page_kb=1024, amazon_page_kb=512, render_delay_ms=200):
+        self.latency = latency  # 1レスポンスごとの待ち時間（秒）
+        self.render_delay_ms = render_delay_ms  # ERESAが商品情報を表示するまでの時間
+        self.requests = Counter()  # ページの種類ごとのリクエスト数
+        self.templates = {name: load_fixture(f'{name}.html') for name in
+                          ('ebay_item', 'ebay_redirect', 'google_images', 'lens_results', 'amazon_item', 'eresa_chart')}
+        ebay_padding = padding(ebay_page_kb)
+        split = len(ebay_padding) // 3  # 商品画像のカルーセルはページの前半にある
+        self.templates['ebay_item'] = (self.templates['ebay_item']
+                                       .replace('<!--PADDING_BEFORE-->', ebay_padding[:split])
+                                       .replace('<!--PADDING_AFTER-->', ebay_padding[split:]))
+        self.templates['amazon_item'] = self.templates['amazon_item'].replace('<!--PADDING-->', padding(amazon_page_kb))
+        self.httpd = None
+        self.base_url = None
+
+    def page(self, path, query):
+        """パスに対応するページの種類とHTMLを返します。"""
+        match = re.fullmatch(r'/ebay/itm/(\d+)', path)
+        if match:
+            item_id = int(match.group(1))
+            # 偶数番号の商品だけ「商品の詳細」にJANコードを載せ、Google画像検索を省略できる行とできない行を混在させる
+            jan = item_jan(item_id) if item_id % 2 == 0 else 'Does not apply'
+            return 'ebay_item', render(self.templates['ebay_item'], ITEM_ID=f'BENCH{item_id}', JAN=jan)
+        match = re.fullmatch(r'/ebay/redirect/(\d+)', path)
+        if match:
+            return 'ebay_redirect', render(self.templates['ebay_redirect'], ITEM_URL=f'{self.base_url}/ebay/itm/{match.group(1)}')
+        if path == '/images':
+            return 'google_images', self.templates['google_images']
+        if path == '/lens/results':
+            if query.get('tab') == ['products']:
+                asin = query.get('asin', [''])[0]
+                results = f'<a href="{self.base_url}/amazon.co.jp/dp/{asin}"><div>Amazon.co.jp: ベンチマーク商品</div></a>'
+            else:
+                image_match = re.search(r'/images/g/BENCH(\d+)/', query.get('url', [''])[0])
+                asin = item_asin(int(image_match.group(1))) if image_match else ''
+                results = '<a href="https://www.example.com/"><div>類似画像</div></a>'
+            return 'lens_results', render(self.templates['lens_results'], ASIN=asin).replace('<!--RESULTS-->', results)
+        match = re.fullmatch(r'/amazon\.co\.jp/dp/(B0\d{8})', path)
+        if match:
+            return 'amazon_item', render(self.templates['amazon_item'], ASIN=match.group(1))
+        if path == '/eresa/chart':
+            asin = query.get('asin', [''])[0]
+            jan = item_jan(int(asin[2:])) if re.fullmatch(r'B0\d{8}', asin) else ''
+            return 'eresa_chart', render(self.templates['eresa_chart'], ASIN=asin, JAN=jan,
+                                         RENDER_DELAY_MS=self.render_delay_ms)
+        return None, None
+
+    def start(self):
+        fixture = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                kind, body = fixture.page(url.path, parse_qs(url.query))
+                fixture.requests[kind or 'not_found'] += 1
+                if fixture.latency:
+                    time.sleep(fixture.latency)
+                if body is None:
+                    self.send_error(404)
+                    return
+                data = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass  # アクセスログは出力しない
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+        threading.Thread(target=self.httpd.serve_forever, name='fixture-server', daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+
+def column_index(column):
+    """列のアルファベット（A, B, ..., AA）を0始まりの番号に変換します。"""
+    index = 0
+    for char in column.upper():
+        index = index * 26 + ord(char) - ord('A') + 1
+    return index - 1
+
+
+def column_letter(index):
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def parse_a1_range(a1_range):
+    """'シート名!C2:C10' 形式の範囲を (開始列, 開始行, 終了列, 終了行) に変換します。"""
+    cells = a1_range.rsplit('!', 1)[-1]
+    start, _, end = cells.partition(':')
+    start_column, start_row = re.fullmatch(r'([A-Z]+)(\d+)', start).groups()
+    end_column, end_row = re.fullmatch(r'([A-Z]+)(\d+)', end or start).groups()
+    return start_column, int(start_row), end_column, int(end_row)
+
+
+class FakeRequest:
+    def __init__(self, service, handler):
+        self.service = service
+        self.handler = handler
+
+    def execute(self, num_retries=0):
+        if self.service.latency:
+            time.sleep(self.service.latency)  # APIの往復時間を再現する
+        return self.handler()
+
+
+class FakeSheetsService:
+    """Google Sheets APIのうち、このツールが使う values().batchGet と values().batchUpdate だけを再現します。"""
+
+    def __init__(self, cells=None, latency=0.0):
+        self.cells = dict(cells or {})  # (列, 行番号) → 値
+        self.latency = latency  # 1回のAPI呼び出しにかかる時間（秒）
+        self.calls = Counter()  # API呼び出しの種類ごとの回数
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def batchGet(self, spreadsheetId, ranges, majorDimension='ROWS'):
+        self.calls['batchGet'] += 1
+        return FakeRequest(self, lambda: self._batch_get(ranges))
+
+    def batchUpdate(self, spreadsheetId, body):
+        self.calls['batchUpdate'] += 1
+        return FakeRequest(self, lambda: self._batch_update(body))
+
+    def _batch_get(self, ranges):
+        value_ranges = []
+        for a1_range in ranges:
+            column, start_row, _, end_row = parse_a1_range(a1_range)
+            values = [self.cells.get((column, row), '') for row in range(start_row, end_row + 1)]
+            while values and values[-1] == '':
+                values.pop()  # 実際のAPIと同様に、末尾の空欄は返さない
+            value_range = {'range': a1_range, 'majorDimension': 'COLUMNS'}
+            if values:
+                value_range['values'] = [values]
+            value_ranges.append(value_range)
+        return {'valueRanges': value_ranges}
+
+    def _batch_update(self, body):
+        for value_range in body['data']:
+            start_column, row, _, _ = parse_a1_range(value_range['range'])
+            for offset, value in enumerate(value_range['values'][0]):
+                if body.get('valueInputOption') == 'USER_ENTERED' and isinstance(value, str) and value.startswith("'"):
+                    value = value[1:]  # 実際のAPIと同様に、先頭の ' は文字列として入力する指定とみなす
+                self.cells[(column_letter(column_index(start_column) + offset), row)] = value
+        return {'totalUpdatedRows': len(body['data'])}
+
+
+def summarize(name, durations, **extra):
+    """処理時間のリストからp50/p95/p99と1秒あたりの処理件数を集計します。"""
+    ordered = sorted(durations)
+
+    def percentile(percent):
+        return ordered[max(0, -(-percent * len(ordered) // 100) - 1)] if ordered else None
+
+    total = sum(ordered)
+    return {
+        'name': name,
+        'count': len(ordered),
+        'p50': percentile(50),
+        'p95': percentile(95),
+        'p99': percentile(99),
+        'per_second': len(ordered) / total if total else None,
+        **extra,
+    }
+
+
+def bench_ebay_parse(tool, server, iterations):
+    """HTTP通信を含めず、eBayの商品ページの解析だけをパーサーごとに計測します。"""
+    content = server.page('/ebay/itm/1', {})[1].encode('utf-8')
+    expected = item_image_url(1)
+    results = []
+    for parser_name, available in (('stream', True), ('bs4', True),
+                                   ('lxml', tool.lxml is not None), ('selectolax', tool.SelectolaxHTMLParser is not None)):
+        if not available:
+            print(f"スキップ: ebay_parse[{parser_name}]（パーサーがインストールされていません）")
+            continue
+        extract_image_urls = tool.EBAY_HTML_PARSERS[parser_name]
+        durations = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            active_image_url, _ = extract_image_urls(content, 'utf-8')
+            durations.append(time.perf_counter() - started)
+            assert active_image_url == expected, f"{parser_name}: {active_image_url} != {expected}"
+        results.append(summarize(f'ebay_parse[{parser_name}]', durations))
+    return results
+
+
+def bench_ebay_image_url(tool, server, iterations):
+    """ローカルサーバーに対してget_ebay_image_urlを呼び出し、通信を含めた処理時間を計測します。5件に1件はリダイレクトページです。"""
+    session = tool.create_http_session()
+    extract_image_urls = tool.select_ebay_html_parser('auto')
+    durations = []
+    for item_id in range(1, iterations + 1):
+        path = 'redirect' if item_id % 5 == 0 else 'itm'
+        started = time.perf_counter()
+        image_url = tool.get_ebay_image_url(f'{server.base_url}/ebay/{path}/{item_id}', session,
+                                            extract_image_urls=extract_image_urls)
+        durations.append(time.perf_counter() - started)
+        assert image_url == item_image_url(item_id), image_url
+    session.close()
+    return [summarize('get_ebay_image_url', durations)]
+
+
+def create_browser(tool, server, **kwargs):
+    return tool.ChromeBrowser(google_images_url=f'{server.base_url}/images', performance_mode=True,
+                              blocked_url_patterns=[], **kwargs)
+
+
+def bench_google_search(tool, server, iterations):
+    """ローカルのGoogle レンズ風のページに対してsearch_amazon_by_image_googleを呼び出します。"""
+    browser = create_browser(tool, server)
+    durations = []
+    try:
+        browser.initialize_driver()
+        for item_id in range(1, iterations + 1):
+            started = time.perf_counter()
+            amazon_url = browser.search_amazon_by_image_google(item_image_url(item_id))
+            durations.append(time.perf_counter() - started)
+            assert amazon_url and item_asin(item_id) in amazon_url, amazon_url
+    finally:
+        browser.close()
+    return [summarize('search_amazon_by_image_google', durations)]
+
+
+def bench_extract_jan_code(tool, server, iterations):
+    """ローカルのAmazon風のページとERESA風のiframeに対してextract_jan_code_from_amazonを呼び出します。"""
+    browser = create_browser(tool, server)
+    durations = []
+    try:
+        browser.initialize_driver()
+        for item_id in range(1, iterations + 1):
+            started = time.perf_counter()
+            jan_code = browser.extract_jan_code_from_amazon(f'{server.base_url}/amazon.co.jp/dp/{item_asin(item_id)}')
+            durations.append(time.perf_counter() - started)
+            assert jan_code == item_jan(item_id), jan_code
+    finally:
+        browser.close()
+    return [summarize('extract_jan_code_from_amazon', durations)]
+
+
+def bench_pipeline(tool, server, rows, workers, sheets_latency):
+    """フェイクのスプレッドシートの読み込みから書き込みまで、本番と同じ流れで処理します。"""
+    start_row = 2
+    end_row = start_row + rows - 1
+    cells = {(EBAY_LINK_COLUMN, row): f'{server.base_url}/ebay/itm/{row}' for row in range(start_row, end_row + 1)}
+    service = FakeSheetsService(cells, sheets_latency)
+    metrics = tool.RunMetrics()
+    writer = tool.SpreadsheetWriter(service, 'benchmark', SHEET_NAME, JAN_CODE_COLUMN, IMAGE_URL_COLUMN, ASIN_COLUMN,
+                                    AMAZON_URL_COLUMN, batch_size=50, flush_interval=30, metrics=metrics)
+    session = tool.create_http_session()
+    prefetcher = tool.EbayImagePrefetcher(session, extract_image_urls=tool.select_ebay_html_parser('auto'), metrics=metrics)
+    ebay_links = tool.iter_ebay_links_from_spreadsheet(service, 'benchmark', SHEET_NAME, EBAY_LINK_COLUMN, start_row, end_row)
+    targets = ((row_number, ebay_url) for row_number, ebay_url, _ in ebay_links if ebay_url)
+    browser_factory = functools.partial(create_browser, tool, server, metrics=metrics)
+    pipeline = tool.RowPipeline(browser_factory, browser_factory, writer, search_workers=workers, eresa_workers=workers,
+                                metrics=metrics)
+    started = time.perf_counter()
+    try:
+        pipeline.run(prefetcher.prefetch(targets))
+    finally:
+        writer.flush()
+        prefetcher.close()
+    elapsed = time.perf_counter() - started
+
+    correct = sum(1 for row in range(start_row, end_row + 1) if service.cells.get((JAN_CODE_COLUMN, row)) == item_jan(row))
+    summary = metrics.summary()
+    result = {
+        'name': f'pipeline[workers={workers}]',
+        'count': rows,
+        'correct': correct,
+        'elapsed': elapsed,
+        'rows_per_hour': rows * 3600 / elapsed if elapsed else None,
+        'sheets_calls': dict(service.calls),
+        'stages': summary['stages'],
+    }
+    assert correct == rows, f"{rows}行中{correct}行のみ正しく書き込まれました"
+    return [result]
+
+
+def calibrate(server, rounds=5):
+    """この環境の処理速度の目安として、標準ライブラリのHTMLParserでeBayの商品ページ全体を解析する時間（最小値）を計測します。
+
+    ツールのコードを使わない一定の処理のため、変更前後で値が変わらず、環境ごとの速度の違いだけを表します。
+    """
+    content = server.page('/ebay/itm/1', {})[1]
+    durations = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        parser = HTMLParser()
+        parser.feed(content)
+        parser.close()
+        durations.append(time.perf_counter() - started)
+    return min(durations)
+
+
+def check_thresholds(results, thresholds, calibration_seconds=None):
+    """閾値（p95の上限、1時間あたりの処理行数の下限）を超えた結果を返します。
+
+    thresholds.jsonの閾値は、calibration_secondsの計測値が基準値（reference_calibration_seconds）だった環境での値です。
+    この環境の計測値が基準値より大きい（遅い）場合は、その比率だけ閾値を緩めます。速い環境でも閾値は厳しくしません。
+    """
+    reference = thresholds.get('reference_calibration_seconds')
+    factor = max(1.0, calibration_seconds / reference) if calibration_seconds and reference else 1.0
+    violations = []
+    for result in results:
+        limits = thresholds.get('limits', {}).get(result['name'], {})
+        if 'max_p95' in limits and result.get('p95') is not None and result['p95'] > limits['max_p95'] * factor:
+            violations.append(f"{result['name']}: p95 {result['p95']:.4f}秒 > 上限 {limits['max_p95'] * factor:.4f}秒")
+        if 'min_rows_per_hour' in limits and result.get('rows_per_hour') is not None \
+                and result['rows_per_hour'] < limits['min_rows_per_hour'] / factor:
+            violations.append(f"{result['name']}: {result['rows_per_hour']:.0f}行/時 < 下限 {limits['min_rows_per_hour'] / factor:.0f}行/時")
+    return violations
+
+
+def print_result(result):
+    if 'rows_per_hour' in result:
+        print(f"{result['name']:<40} {result['count']:>5}行 {result['elapsed']:>8.2f}秒 "
+              f"{result['rows_per_hour']:>10.0f}行/時 Sheets API: {result['sheets_calls']}")
+        for stage, stats in result['stages'].items():
+            print(f"    {stage:<36} {stats['count']:>5}回 p50={stats['p50']:.3f}秒 p95={stats['p95']:.3f}秒 p99={stats['p99']:.3f}秒")
+    else:
+        print(f"{result['name']:<40} {result['count']:>5}回 p50={result['p50'] * 1000:>9.2f}ms "
+              f"p95={result['p95'] * 1000:>9.2f}ms p99={result['p99'] * 1000:>9.2f}ms {result['per_second']:>9.1f}件/秒")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="記録済みのページを使ったオフラインのベンチマークを実行します。")
+    parser.add_argument('--iterations', type=int, default=50, help="単体のベンチマークの繰り返し回数")
+    parser.add_argument('--rows', type=int, default=40, help="パイプラインのベンチマークで処理する行数")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8], help="パイプラインのベンチマークのワーカー数")
+    parser.add_argument('--latency', type=float, default=0.05, help="ローカルサーバーの1レスポンスごとの待ち時間（秒）")
+    parser.add_argument('--sheets-latency', type=float, default=0.2, help="フェイクのSheets APIの1回の呼び出しにかかる時間（秒）")
+    parser.add_argument('--no-browser', action='store_true', help="Chromeを使うベンチマークを実行しない")
+    parser.add_argument('--output', help="結果をJSON形式で保存するファイル")
+    parser.add_argument('--thresholds', default=THRESHOLDS_FILE, help="回帰を判定する閾値のファイル")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)s [%(threadName)s] %(message)s')
+    tool = load_tool()
+    tool.logger.setLevel(logging.ERROR)
+
+    server = FixtureServer(latency=args.latency).start()
+    results = []
+    calibration_seconds = calibrate(server)
+    print(f"この環境の基準処理時間: {calibration_seconds * 1000:.2f}ms（閾値はこの値に合わせて調整されます）")
+    try:
+        results += bench_ebay_parse(tool, server, args.iterations)
+        results += bench_ebay_image_url(tool, server, args.iterations)
+        if args.no_browser:
+            print("スキップ: Chromeを使うベンチマーク（--no-browser）")
+        else:
+            results += bench_google_search(tool, server, args.iterations)
+            results += bench_extract_jan_code(tool, server, args.iterations)
+            for workers in args.workers:
+                results += bench_pipeline(tool, server, args.rows, workers, args.sheets_latency)
+    finally:
+        server.stop()
+
+    for result in results:
+        print_result(result)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    with open(args.thresholds, 'r', encoding='utf-8') as f:
+        violations = check_thresholds(results, json.load(f), calibration_seconds)
+    for violation in violations:
+        print(f"閾値超過: {violation}")
+    return 1 if violations else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
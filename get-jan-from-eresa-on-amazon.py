@@ -1,10 +1,22 @@
 import os
+import io
+import json
+import math
+import logging
+import argparse
 import configparser
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 import re
+import html
+import queue
+import sqlite3
+import shutil
+import tempfile
 
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
@@ -14,11 +26,147 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from webdriver_manager.chrome import ChromeDriverManager
 import time
+import threading
+import functools
+from collections import deque, defaultdict, Counter
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from html.parser import HTMLParser
 from selenium.webdriver.common.keys import Keys
+from selenium.common.exceptions import TimeoutException, SessionNotCreatedException, InvalidSessionIdException, NoSuchWindowException
+
+# 高速なHTMLパーサー（任意）。インストールされていない場合は標準ライブラリによる逐次解析を使用します。
+try:
+    # selectolax 1.0以降はLexborのパーサーだけを提供する（selectolax.parserはImportErrorになる）
+    from selectolax.lexbor import LexborHTMLParser as SelectolaxHTMLParser
+except ImportError:
+    try:
+        from selectolax.parser import HTMLParser as SelectolaxHTMLParser  # 0.xの旧バージョン
+    except ImportError:
+        SelectolaxHTMLParser = None
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+try:
+    import psutil  # 任意: ブラウザのメモリ使用量の監視に使用
+except ImportError:
+    psutil = None
+try:
+    from PIL import Image  # 任意: eBay画像の知覚ハッシュの計算に使用
+except ImportError:
+    Image = None
 
 # 設定ファイルのパス
 CONFIG_FILE = 'config.ini'
 
+logger = logging.getLogger('ebay_jan')
+
+# ブラウザ操作の各段階で待機する時間の上限（秒）。設定ファイルのSTAGE_TIMEOUTSで上書きできます。
+DEFAULT_STAGE_TIMEOUTS = {
+    'page_load': 30,        # ページ読み込み（driver.get）
+    'google_page': 10,      # Google画像検索ページの表示
+    'lens_input': 10,       # 画像URLの入力欄の表示と入力
+    'search_results': 20,   # 画像検索結果（商品ボタン）の表示
+    'product_results': 10,  # 商品タブの検索結果（Amazonのリンク）の表示
+    'eresa_iframe': 20,     # ERESAのiframeの表示
+    'eresa_login': 20,      # ERESAのログイン処理の各段階
+    'jan_code': 20,         # JANコードの表示
+}
+
+# パフォーマンスモードで読み込みをブロックするURLのパターン（画像・動画・フォント・広告・トラッカー）
+DEFAULT_BLOCKED_URL_PATTERNS = [
+    '*.jpg', '*.jpeg', '*.png', '*.gif', '*.webp', '*.avif', '*.ico',
+    '*.mp4', '*.webm', '*.m3u8',
+    '*.woff', '*.woff2', '*.ttf', '*.otf',
+    '*doubleclick.net*', '*googlesyndication.com*', '*googleadservices.com*',
+    '*google-analytics.com*', '*googletagmanager.com*',
+    '*amazon-adsystem.com*', '*fls-fe.amazon.co.jp*', '*unagi.amazon.co.jp*',
+]
+
+# Google画像検索のページ
+GOOGLE_IMAGES_URL = "https://images.google.com/"
+
+# ERESAのログイン状態の判定に使う要素
+ERESA_LOGIN_INPUT_XPATH = "//input[@placeholder='メールアドレスを入力してください']"
+ERESA_HEADER_SELECTOR = "header.header"
+
+# ERESAのiframe内で実行し、JANコードが表示されるまでMutationObserverで待機してから
+# 商品情報の項目（項目名 → 値）をまとめて返すスクリプト。引数は待機時間の上限（ミリ秒）
+ERESA_FIELDS_SCRIPT = """
+var done = arguments[arguments.length - 1];
+var timeoutMs = arguments[0];
+function collect() {
+  var fields = {};
+  var labels = document.querySelectorAll('div.font-weight-bold.border-bottom');
+  for (var i = 0; i < labels.length; i++) {
+    var label = labels[i].textContent.trim();
+    var container = labels[i].nextElementSibling;
+    var span = container && container.querySelector('span');
+    if (label && span && !(label in fields)) {
+      fields[label] = span.textContent.trim();
+    }
+  }
+  return fields;
+}
+function hasJanCode(fields) {
+  for (var label in fields) {
+    if (label.indexOf('JAN') !== -1 && /^[0-9-]+$/.test(fields[label])) {
+      return true;
+    }
+  }
+  return false;
+}
+var fields = collect();
+if (hasJanCode(fields)) {
+  done(fields);
+} else {
+  var timer;
+  var observer = new MutationObserver(function () {
+    var fields = collect();
+    if (hasJanCode(fields)) {
+      observer.disconnect();
+      clearTimeout(timer);
+      done(fields);
+    }
+  });
+  observer.observe(document, {childList: true, subtree: true, characterData: true});
+  timer = setTimeout(function () {
+    observer.disconnect();
+    done(collect());
+  }, timeoutMs);
+}
+"""
+JAN_EXTRACTION_MODES = ('observer', 'polling')
+
+# GoogleやAmazonがCAPTCHA・アクセス制限のページを表示しているかを判定するスクリプト
+BLOCK_PAGE_SCRIPT = """
+if (/\\/sorry\\/|validateCaptcha/.test(location.href)) {
+  return true;
+}
+if (document.querySelector("form[action*='validateCaptcha'], form#captcha-form, iframe[src*='recaptcha']")) {
+  return true;
+}
+var text = document.body ? document.body.textContent.slice(0, 20000) : '';
+return /unusual traffic|通常と異なるトラフィック|ロボットでないことを確認|Enter the characters you see below|表示されている文字を入力/i.test(text);
+"""
+
+# googleapiclientのサービスはスレッドセーフではないため、Sheets APIの呼び出しを直列化するためのロック
+SHEETS_API_LOCK = threading.Lock()
+
+# 複数のワーカーが同時にChromeDriverをダウンロードしないようにするためのロック
+DRIVER_INSTALL_LOCK = threading.Lock()
+
+# webdriver-managerで解決したChromeDriverのパスを保存するファイル
+DRIVER_PATH_CACHE_FILE = 'chromedriver_path.json'
+
+# このプロセスで解決済みのChromeDriverのパス（ワーカー間で共有）
+resolved_driver_path = None
+
+# CDPのNetwork.setCookiesに渡せるCookieの項目
+CDP_COOKIE_FIELDS = ('name', 'value', 'domain', 'path', 'secure', 'httpOnly', 'sameSite', 'expires')
+
 
 def load_config():
     """設定ファイルを読み込みます。"""
@@ -27,138 +175,1138 @@ def load_config():
         with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
             config.read_file(f)
     except FileNotFoundError:
-        print(f"エラー: 設定ファイル '{CONFIG_FILE}' が見つかりません。")
+        logger.error(f"エラー: 設定ファイル '{CONFIG_FILE}' が見つかりません。")
         return None
     except configparser.Error as e:
-        print(f"エラー: 設定ファイルの読み込みに失敗しました: {e}")
+        logger.error(f"エラー: 設定ファイルの読み込みに失敗しました: {e}")
         return None
     return config['DEFAULT']
 
 
 def authenticate_sheets_api(credentials_file):
     """Google Sheets APIを認証します。"""
-    print("認証処理を開始します")
-    print(f"credのファイルパス: {credentials_file}を確認中")
+    logger.info("認証処理を開始します")
+    logger.debug(f"credのファイルパス: {credentials_file}を確認中")
     try:
         if os.path.exists(credentials_file):
-            print("サービスアカウントキーファイルが存在します")
+            logger.debug("サービスアカウントキーファイルが存在します")
             creds = service_account.Credentials.from_service_account_file(
                 credentials_file, scopes=['https://www.googleapis.com/auth/spreadsheets']
             )
-            print("認証情報を読み込みました")
+            logger.debug("認証情報を読み込みました")
 
             service = build('sheets', 'v4', credentials=creds)
-            print("APIクライアントを作成しました")
+            logger.debug("APIクライアントを作成しました")
             return service
         else:
-            print("サービスアカウントキーファイルが存在しません")
+            logger.error("サービスアカウントキーファイルが存在しません")
             return None
 
     except Exception as e:
-        print(f"認証エラー: {type(e)}, {e}")
+        logger.error(f"認証エラー: {type(e)}, {e}")
         return None
 
 
-def get_ebay_links_from_spreadsheet(service, spreadsheet_id, sheet_name, ebay_link_column, start_row):
-    """スプレッドシートから指定範囲のeBayリンクを取得します。"""
+def get_ebay_links_from_spreadsheet(service, spreadsheet_id, sheet_name, ebay_link_column, start_row, end_row, filled_columns=(),
+                                    num_retries=5):
+    """スプレッドシートから指定範囲のeBayリンクを取得します。
+
+    eBayリンクの列とfilled_columns（JANコード列・ASIN列など）をvalues().batchGetで1回で読み込み、
+    (行番号, eBay URL, 記入済みかどうか) のリストを返します。取得に失敗した場合はNoneを返します。
+    一時的なエラー（5xx・429）はnum_retries回まで、間隔を空けながら再送します。
+    """
     try:
         sheet = service.spreadsheets()
-        result = sheet.values().get(spreadsheetId=spreadsheet_id,
-                                    range=f'{sheet_name}!{ebay_link_column}{start_row}:{ebay_link_column}').execute()
-        ebay_links = result.get('values', [])
-        return [link[0] for link in ebay_links] if ebay_links else []  # リスト内包表記でURLのみを抽出
+        columns = [ebay_link_column, *[column for column in filled_columns if column]]
+        ranges = [f'{sheet_name}!{column}{start_row}:{column}{end_row}' for column in columns]
+        with SHEETS_API_LOCK:
+            result = sheet.values().batchGet(spreadsheetId=spreadsheet_id, ranges=ranges,
+                                             majorDimension='COLUMNS').execute(num_retries=num_retries)
+        column_values = []
+        for value_range in result.get('valueRanges', []):
+            values = value_range.get('values', [])
+            column_values.append(values[0] if values else [])
+        ebay_links = column_values[0] if column_values else []
+
+        rows = []
+        for offset, link in enumerate(ebay_links):
+            filled = any(offset < len(values) and str(values[offset]).strip() for values in column_values[1:])
+            rows.append((start_row + offset, str(link).strip(), filled))
+        return rows
     except Exception as e:
-        print(f"スプレッドシートからのリンク取得エラー: {e}")
+        logger.error(f"スプレッドシートからのリンク取得エラー: {e}")
         return None
 
 
-def get_ebay_image_url(ebay_url):
-    """eBayの商品ページから画像URLを取得します。リダイレクトに対応し、指定されたクラスのdivタグから画像URLを検出し、active imageを優先します。"""
-    try:
-        try:
-            response = requests.get(ebay_url, timeout=20)  # タイムアウトを設定
-            response.raise_for_status()
-        except requests.exceptions.RequestException as e:
-            print(f"eBayからのリクエストエラー: {e}")
+class SpreadsheetReadError(Exception):
+    """スプレッドシートの読み込みが、再試行しても失敗したことを表します。"""
+
+
+def iter_ebay_links_from_spreadsheet(service, spreadsheet_id, sheet_name, ebay_link_column, start_row, end_row, filled_columns=(), page_size=500,
+                                     stop_at_empty_page=False, max_attempts=3):
+    """開始行から終了行までをpage_size行ずつ読み込み、(行番号, eBay URL, 記入済みかどうか) を順に返します。
+
+    現在のページを処理している間に、次のページをバックグラウンドで先読みします。
+    ページの読み込みはmax_attempts回まで再試行し、それでも失敗した場合は、残りの行を処理せずに終わらないよう
+    SpreadsheetReadErrorを送出します。stop_at_empty_pageがTrueの場合は、eBayリンクが1件もないページをシートの末尾とみなします。
+    """
+    page_size = max(1, page_size)
+
+    def fetch_page(page_start):
+        page_end = min(page_start + page_size - 1, end_row)
+        for attempt in range(1, max_attempts + 1):
+            rows = get_ebay_links_from_spreadsheet(
+                service, spreadsheet_id, sheet_name, ebay_link_column, page_start, page_end, filled_columns)
+            if rows is not None:
+                return page_start, page_end, rows
+            if attempt < max_attempts:
+                logger.warning(f"{page_start}行目から{page_end}行目までの読み込みを再試行します。（{attempt}/{max_attempts - 1}回目）")
+                time.sleep(2 ** attempt)
+        raise SpreadsheetReadError(f"{sheet_name}の{page_start}行目から{page_end}行目までのeBayリンクを読み込めませんでした。")
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_page = executor.submit(fetch_page, start_row) if start_row <= end_row else None
+        while next_page:
+            page_start, page_end, rows = next_page.result()
+            has_next = page_end < end_row and (rows or not stop_at_empty_page)
+            next_page = executor.submit(fetch_page, page_end + 1) if has_next else None
+            logger.info(f"{page_start}行目から{page_end}行目までのeBayリンクを読み込みました。")
+            yield from rows
+
+
+class CheckpointJournal:
+    """行ごとの処理状況をJSON Lines形式で記録し、中断した処理を途中から再開できるようにします。
+
+    複数のシート（ジョブ）で同じファイルを共有できるよう、記録にはシートを表すキーを付け、ファイルごとのロックで書き込みます。
+    """
+
+    locks = {}  # ファイルのパス → ロック（同じファイルを使うインスタンスで共有する）
+    locks_guard = threading.Lock()
+
+    def __init__(self, path, spreadsheet_id, sheet_name, job_name=None):
+        self.path = path
+        self.sheet_key = f'{spreadsheet_id}/{sheet_name}'  # 別のシートの記録と混ざらないようにする
+        if job_name:
+            # 同じシートの別の列・行範囲を処理するジョブの記録と混ざらないよう、ジョブ名も含める
+            self.sheet_key += f'#{job_name}'
+        with self.locks_guard:
+            self.lock = self.locks.setdefault(os.path.abspath(path), threading.Lock())
+
+    def load(self):
+        """記録済みの行番号と処理状況の辞書を返します。"""
+        statuses = {}
+        if not os.path.exists(self.path):
+            return statuses
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # 書き込み途中で終了した行は無視する
+                if entry.get('sheet') == self.sheet_key:
+                    statuses[entry['row']] = entry['status']
+        return statuses
+
+    def reset(self):
+        """このシートの記録を消去します。他のシートの記録はそのまま残します。"""
+        with self.lock:
+            kept = []
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            continue
+                        if entry.get('sheet') != self.sheet_key:
+                            kept.append(line)
+            with open(self.path, 'w', encoding='utf-8') as f:
+                f.writelines(kept)
+
+    def record(self, entries):
+        """(行番号, 処理状況) のリストを記録します。"""
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                for row_number, status in entries:
+                    f.write(json.dumps({'sheet': self.sheet_key, 'row': row_number, 'status': status,
+                                        'time': time.time()}, ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+
+class ResultCache:
+    """処理結果をSQLiteに保存し、次回以降の実行で再利用するためのキャッシュです。
+
+    以下の4種類（tier）の結果を、それぞれの有効期限と件数上限で管理します。
+    - ebay_image: eBay URL（正規化済み）→ 画像URL
+    - amazon_url: 画像URL（正規化済み）→ AmazonのURL
+    - jan_code: ASIN → JANコード
+    - image_hash: eBay画像の知覚ハッシュ → 確定したAmazonのURL・ASIN・JANコード
+    """
+
+    TIERS = ('ebay_image', 'amazon_url', 'jan_code', 'image_hash')
+    EVICT_INTERVAL = 1000  # 何件保存するごとに件数上限を確認するか
+
+    def __init__(self, path, ttl_seconds, max_entries=100000):
+        self.ttl_seconds = ttl_seconds  # tierごとの有効期限（秒）
+        self.max_entries = max_entries  # tierごとの最大件数
+        self.unchecked_sets = Counter()  # tierごとの、前回件数上限を確認してから保存した件数
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "tier TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL, PRIMARY KEY (tier, key))"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS cache_tier_accessed ON cache (tier, accessed_at)")
+
+    def get(self, tier, key):
+        """キャッシュから値を取得します。存在しないか有効期限切れの場合はNoneを返します。"""
+        if not key:
             return None
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT value, created_at FROM cache WHERE tier = ? AND key = ?",
+                                    (tier, key)).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if now - created_at > self.ttl_seconds[tier]:
+                self.conn.execute("DELETE FROM cache WHERE tier = ? AND key = ?", (tier, key))
+                return None
+            self.conn.execute("UPDATE cache SET accessed_at = ? WHERE tier = ? AND key = ?", (now, tier, key))
+            return value
+
+    def set(self, tier, key, value):
+        """キャッシュに値を保存します。EVICT_INTERVAL件保存するごとに、件数上限を超えた分を古い順に削除します。"""
+        if not key or not value:
+            return
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO cache (tier, key, value, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                              (tier, key, value, now, now))
+            self.unchecked_sets[tier] += 1
+            # 削除のための並べ替えは件数が多いと遅いため、保存のたびには行わない
+            if self.unchecked_sets[tier] >= min(self.EVICT_INTERVAL, max(1, self.max_entries)):
+                self._evict(tier)
+
+    def _evict(self, tier):
+        """件数上限を超えていれば、最後に使われた日時が古いものから削除します。lockを取得した状態で呼び出します。"""
+        self.unchecked_sets[tier] = 0
+        count = self.conn.execute("SELECT COUNT(*) FROM cache WHERE tier = ?", (tier,)).fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM cache WHERE tier = ? AND key IN ("
+                "SELECT key FROM cache WHERE tier = ? ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (tier, tier, self.max_entries)
+            )
+
+    def items(self, tier):
+        """有効期限内のすべての (キー, 値) のリストを返します。"""
+        oldest = time.time() - self.ttl_seconds[tier]
+        with self.lock:
+            return self.conn.execute("SELECT key, value FROM cache WHERE tier = ? AND created_at >= ?",
+                                     (tier, oldest)).fetchall()
+
+    def close(self):
+        with self.lock:
+            with self.conn:
+                for tier in [tier for tier, count in self.unchecked_sets.items() if count]:
+                    self._evict(tier)  # 最後の確認以降に保存した分も件数上限に収める
+            self.conn.close()
+
+
+EBAY_ITEM_ID_PATTERN = re.compile(r'/itm/(?:[^/?#]+/)?(\d{9,15})(?:[/?#]|$)')
+EBAY_ITEM_QUERY_PATTERN = re.compile(r'[?&]item=(\d{9,15})(?:&|$)')
+EBAY_IMAGE_SIZE_PATTERN = re.compile(r'/s-l\d+\.\w+$')
+
+
+def normalize_ebay_url(ebay_url):
+    """eBayのURLから商品番号を取り出し、同じ商品を指すURLが同じ値になるように正規化します。
+
+    商品番号が見つからない場合は、トラッキング用のクエリとフラグメントを取り除いたURLを返します。
+    """
+    if not ebay_url:
+        return ebay_url
+    match = EBAY_ITEM_ID_PATTERN.search(ebay_url) or EBAY_ITEM_QUERY_PATTERN.search(ebay_url)
+    if match:
+        return f'ebay:item:{match.group(1)}'
+    url = urlparse(ebay_url.strip())
+    return f'{url.netloc.lower()}{url.path}'
+
+
+def normalize_image_url(image_url):
+    """画像URLからクエリとeBayの画像サイズ（s-l1600.jpgなど）を取り除き、同じ画像を指すURLが同じ値になるように正規化します。"""
+    if not image_url:
+        return image_url
+    url = urlparse(image_url.strip())
+    return f'{url.netloc.lower()}{EBAY_IMAGE_SIZE_PATTERN.sub("/s-l", url.path)}'
+
+
+class RunDedupIndex:
+    """1回の実行の中で、同じキーに対する取得処理を1回だけ実行し、結果を他の行で再利用するための索引です。
+
+    キーの処理中に同じキーが要求された場合は、新たに処理を始めず、処理中のスレッドの結果を待ちます。
+    処理中に例外が発生した場合は結果を記録せず、待っていたスレッドのうち1つが改めて処理します。
+    """
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics  # 再利用した件数の記録
+        self.lock = threading.Lock()
+        self.results = {}  # (種類, キー) → 結果
+        self.in_flight = {}  # (種類, キー) → 処理の完了を通知するEvent
+
+    def lookup(self, kind, key, fetch):
+        """種類kindのキーkeyに対する結果を返します。未取得の場合だけfetch()を呼び出します。"""
+        if not key:
+            return fetch()
+        entry = (kind, key)
+        waited = False
+        while True:
+            with self.lock:
+                if entry in self.results:
+                    result, owner = self.results[entry], False
+                    break
+                event = self.in_flight.get(entry)
+                if event is None:
+                    event = self.in_flight[entry] = threading.Event()  # このスレッドが処理を担当する
+                    owner = True
+                    break
+            waited = True
+            logger.debug(f"処理中の{kind}の結果を待ちます: {key}")
+            event.wait()
+        if not owner:
+            logger.debug(f"実行中に取得済みの{kind}を再利用しました: {key}")
+            if self.metrics:
+                self.metrics.record_dedup(kind, waited)
+            return result
 
         try:
-            soup = BeautifulSoup(response.content, 'html.parser')
+            result = fetch()
+            with self.lock:
+                self.results[entry] = result
+            return result
+        finally:
+            with self.lock:
+                self.in_flight.pop(entry, None)
+            event.set()
+
+
+EBAY_THUMBNAIL_SIZE = 225  # 知覚ハッシュの計算に使うeBay画像の大きさ（s-l225）
+IMAGE_HASH_MIN_BITS = 8  # dHashの1のビットがこれより少ない（64からこれを引いた数より多い）画像は、模様が少なく区別できないため使わない
+IMAGE_MIN_CONTRAST = 8.0  # 明るさの標準偏差がこれより小さい画像（単色の画像や「画像なし」の表示など）は使わない
+IMAGE_COLOR_GRID = 4  # 色の比較に使う、縮小した画像のマスの数（4×4）
+IMAGE_COLOR_TOLERANCE = 24  # 同じ画像とみなす、マスごとの平均色（RGBそれぞれ0〜255）の差の上限
+
+
+def ebay_thumbnail_url(image_url):
+    """eBayの画像URLを、同じ画像の小さいサイズのURLに置き換えます。"""
+    return EBAY_IMAGE_SIZE_PATTERN.sub(lambda match: f'/s-l{EBAY_THUMBNAIL_SIZE}' + os.path.splitext(match.group(0))[1], image_url)
+
+
+def compute_image_fingerprint(content, hash_size=8):
+    """画像の (dHash, 明るさの標準偏差, マスごとの平均色のリスト) を返します。Pillowが必要です。
+
+    dHashは隣り合う画素の明るさの大小を並べた hash_size*hash_size ビットの整数で、色の違いを区別できないため、
+    IMAGE_COLOR_GRID×IMAGE_COLOR_GRID マスごとの平均色（R, G, B の順に並べたリスト）も合わせて返します。
+    """
+    with Image.open(io.BytesIO(content)) as image:
+        rgb = image.convert('RGB')
+        pixels = list(rgb.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS).getdata())
+        colors = [channel for pixel in rgb.resize((IMAGE_COLOR_GRID, IMAGE_COLOR_GRID), Image.BOX).getdata() for channel in pixel]
+    value = 0
+    for y in range(hash_size):
+        row = pixels[y * (hash_size + 1):(y + 1) * (hash_size + 1)]
+        for left, right in zip(row, row[1:]):
+            value = (value << 1) | (left > right)
+    mean = sum(pixels) / len(pixels)
+    contrast = math.sqrt(sum((pixel - mean) ** 2 for pixel in pixels) / len(pixels))
+    return value, contrast, colors
+
+
+def is_informative_image_hash(image_hash, contrast, hash_bits=64):
+    """ほかの画像と区別できるだけの模様がある画像かどうかを返します。"""
+    bits = bin(image_hash).count('1')
+    return contrast >= IMAGE_MIN_CONTRAST and IMAGE_HASH_MIN_BITS <= bits <= hash_bits - IMAGE_HASH_MIN_BITS
+
+
+def image_colors_match(colors, other_colors):
+    """マスごとの平均色の差が、すべてIMAGE_COLOR_TOLERANCE以内かどうかを返します。"""
+    if not colors or not other_colors or len(colors) != len(other_colors):
+        return False
+    return max(abs(a - b) for a, b in zip(colors, other_colors)) <= IMAGE_COLOR_TOLERANCE
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    """ハミング距離が近いハッシュを、すべてのハッシュと比較せずに探すためのBK木です。"""
+
+    def __init__(self):
+        self.root = None  # [ハッシュ, 値, {親との距離: 子ノード}]
+        self.size = 0
+
+    def add(self, key, value):
+        """ハッシュkeyと値を追加します。同じハッシュがすでにある場合は値を置き換えます。"""
+        if self.root is None:
+            self.root = [key, value, {}]
+            self.size = 1
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(key, node[0])
+            if distance == 0:
+                node[1] = value
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [key, value, {}]
+                self.size += 1
+                return
+            node = child
+
+    def search(self, key, max_distance):
+        """距離がmax_distance以下の (距離, ハッシュ, 値) を、距離の近い順に返します。"""
+        matches = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(key, node[0])
+            if distance <= max_distance:
+                matches.append((distance, node[0], node[1]))
+            # 三角不等式により、距離の差が探索範囲を超える子ノードには近いハッシュがない
+            stack.extend(child for child_distance, child in node[2].items() if abs(child_distance - distance) <= max_distance)
+        matches.sort(key=lambda match: match[0])
+        return matches
+
+
+class ImageHashIndex:
+    """eBay画像の知覚ハッシュ（dHash）から、過去に確定したAmazonのURL・ASIN・JANコードを探すための索引です。
+
+    出品者ごとにURLが異なる同じ画像（メーカーの商品画像など）を、Google画像検索を使わずに解決します。
+    単色や模様の少ない画像は別の商品と区別できないため索引に使わず、ハッシュが近くても平均色が異なる画像（色違いの商品など）は
+    同じ画像とみなしません。
+    キャッシュが指定されている場合は、起動時にキャッシュのimage_hashから索引を作り、確定した結果を保存します。
+    """
+
+    def __init__(self, cache=None, threshold=5, metrics=None):
+        self.cache = cache
+        self.threshold = threshold  # 同じ画像とみなすハミング距離の上限（64ビット中）
+        self.metrics = metrics
+        self.tree = BKTree()
+        self.lock = threading.Lock()
+        if cache:
+            for key, value in cache.items('image_hash'):
+                try:
+                    self.tree.add(int(key, 16), json.loads(value))
+                except ValueError:
+                    continue
+            logger.info(f"キャッシュから{self.tree.size}件の画像の知覚ハッシュを読み込みました。")
+
+    def fingerprint(self, image_url, session=None):
+        """eBay画像の縮小版を取得し、{'hash': dHash, 'colors': マスごとの平均色} を返します。
+
+        取得・解析に失敗した場合や、模様が少なくほかの画像と区別できない場合はNoneを返します。
+        """
+        http = session or requests
+        try:
+            with timed(self.metrics, 'image_hash'):
+                response = http.get(ebay_thumbnail_url(image_url), timeout=20)
+                response.raise_for_status()
+                image_hash, contrast, colors = compute_image_fingerprint(response.content)
         except Exception as e:
-            print(f"BeautifulSoup解析エラー: {e}")
+            logger.debug(f"画像の知覚ハッシュを計算できませんでした: {image_url}: {e}")
             return None
+        if not is_informative_image_hash(image_hash, contrast):
+            logger.debug(f"模様の少ない画像のため、知覚ハッシュを使いません: {image_url}")
+            return None
+        return {'hash': image_hash, 'colors': colors}
 
-        # リダイレクトページを検出
-        if "Redirecting you to" in soup.get_text():
-            print("リダイレクトページを検出しました。")
-            # リダイレクト先のURLを取得
-            redirect_url = soup.find('meta', attrs={'http-equiv': 'refresh'})
-            if redirect_url and 'url=' in redirect_url.get('content', ''):
-                redirect_url_value = redirect_url.get('content').split('url=')[1]
+    def lookup(self, fingerprint):
+        """ハッシュがしきい値以内で平均色も近い、最も近い画像の結果と距離の組を返します。見つからない場合はNoneを返します。"""
+        with self.lock:
+            matches = self.tree.search(fingerprint['hash'], self.threshold)
+        for distance, _, result in matches:
+            if image_colors_match(result.get('colors'), fingerprint['colors']):
+                return result, distance
+        return None
+
+    def add(self, fingerprint, result):
+        """画像の知覚ハッシュと確定した結果（amazon_url, asin, jan）を登録します。"""
+        entry = dict(result, colors=fingerprint['colors'])
+        with self.lock:
+            self.tree.add(fingerprint['hash'], entry)
+        if self.cache:
+            self.cache.set('image_hash', f"{fingerprint['hash']:016x}", json.dumps(entry, ensure_ascii=False))
+
+
+def parse_stage_timeouts(value):
+    """"google_page:5, search_results:15" 形式の文字列を解析し、既定値を上書きした待機時間の上限を返します。"""
+    stage_timeouts = dict(DEFAULT_STAGE_TIMEOUTS)
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        stage, _, seconds = item.partition(':')
+        stage = stage.strip()
+        if stage not in stage_timeouts:
+            logger.warning(f"警告: 不明なステージ名のため無視します: {stage}")
+            continue
+        stage_timeouts[stage] = float(seconds)
+    return stage_timeouts
+
+
+def percentile(values, percent):
+    """最近傍順位法でパーセンタイル値を返します。"""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+class RunMetrics:
+    """行ごと・段階ごとの処理時間と結果をJSON Lines形式で記録し、終了時に段階ごとの集計を出力します。
+
+    主な段階: ebay_fetch, ebay_parse, google_search, amazon_load, eresa_iframe, sheet_write
+    """
+
+    def __init__(self, path=None):
+        self.file = open(path, 'a', encoding='utf-8', buffering=1) if path else None  # 行単位で書き出す
+        self.lock = threading.Lock()
+        self.local = threading.local()  # スレッドごとの処理中の行番号
+        self.durations = defaultdict(list)  # 段階 → 処理時間（秒）のリスト
+        self.outcomes = Counter()  # 行の処理結果ごとの件数
+        self.retries = Counter()  # 段階ごとの再試行回数
+        self.dedup_hits = Counter()  # 種類ごとの、実行中に取得済みの結果を再利用した回数
+        self.started_at = time.monotonic()
+
+    def _emit(self, event):
+        if self.file:
+            event['time'] = round(time.time(), 3)
+            self.file.write(json.dumps(event, ensure_ascii=False) + '\n')
+
+    @contextmanager
+    def row(self, row_number):
+        """このスレッドで記録する段階の処理時間に行番号を付けます。"""
+        previous = getattr(self.local, 'row_number', None)
+        self.local.row_number = row_number
+        try:
+            yield
+        finally:
+            self.local.row_number = previous
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """with文の中の処理時間を段階nameの処理時間として記録します。"""
+        started = time.monotonic()
+        status = 'ok'
+        try:
+            yield
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            self.record_stage(name, time.monotonic() - started, status, **fields)
+
+    def record_stage(self, name, seconds, status='ok', **fields):
+        with self.lock:
+            self.durations[name].append(seconds)
+            self._emit({'event': 'stage', 'row': getattr(self.local, 'row_number', None), 'stage': name,
+                        'seconds': round(seconds, 4), 'status': status, **fields})
+
+    def record_row(self, row_number, outcome, seconds, **fields):
+        with self.lock:
+            self.outcomes[outcome] += 1
+            self._emit({'event': 'row', 'row': row_number, 'outcome': outcome, 'seconds': round(seconds, 4), **fields})
+
+    def record_retry(self, stage, reason):
+        with self.lock:
+            self.retries[stage] += 1
+            self._emit({'event': 'retry', 'row': getattr(self.local, 'row_number', None), 'stage': stage, 'reason': str(reason)[:200]})
+
+    def record_dedup(self, kind, waited=False):
+        with self.lock:
+            self.dedup_hits[kind] += 1
+            self._emit({'event': 'dedup', 'row': getattr(self.local, 'row_number', None), 'kind': kind, 'waited': waited})
+
+    def summary(self):
+        """段階ごとのp50/p95/p99と、1時間あたりの処理行数を集計します。"""
+        with self.lock:
+            elapsed = time.monotonic() - self.started_at
+            rows = sum(self.outcomes.values())
+            stages = {
+                name: {
+                    'count': len(values),
+                    'total': round(sum(values), 3),
+                    'p50': round(percentile(values, 50), 3),
+                    'p95': round(percentile(values, 95), 3),
+                    'p99': round(percentile(values, 99), 3),
+                }
+                for name, values in self.durations.items() if values
+            }
+            return {
+                'event': 'summary',
+                'elapsed_seconds': round(elapsed, 3),
+                'rows': rows,
+                'rows_per_hour': round(rows * 3600 / elapsed, 1) if elapsed > 0 else 0.0,
+                'outcomes': dict(self.outcomes),
+                'retries': dict(self.retries),
+                'dedup_hits': dict(self.dedup_hits),
+                'stages': stages,
+            }
+
+    def close(self):
+        """集計結果を記録・表示し、ファイルを閉じます。"""
+        summary = self.summary()
+        logger.info(f"処理行数: {summary['rows']}行 / 経過時間: {summary['elapsed_seconds']}秒 / "
+                    f"1時間あたり: {summary['rows_per_hour']}行 / 結果: {summary['outcomes']} / 再試行: {summary['retries']} / "
+                    f"再利用: {summary['dedup_hits']}")
+        for name, stats in summary['stages'].items():
+            logger.info(f"  {name}: {stats['count']}回 合計{stats['total']}秒 "
+                        f"p50={stats['p50']}秒 p95={stats['p95']}秒 p99={stats['p99']}秒")
+        with self.lock:
+            self._emit(summary)
+            if self.file:
+                self.file.close()
+                self.file = None
+
+
+def timed(metrics, stage, **fields):
+    """metricsが指定されていれば段階の処理時間を記録し、なければ何もしないコンテキストを返します。"""
+    return metrics.stage(stage, **fields) if metrics else nullcontext()
+
+
+def create_http_session(pool_size=10, max_retries=3, backoff_factor=1.0):
+    """keep-aliveで接続を再利用し、失敗時はバックオフ付きで再試行するHTTPセッションを作成します。"""
+    session = requests.Session()
+    retry = Retry(total=max_retries, backoff_factor=backoff_factor,
+                  status_forcelist=(429, 500, 502, 503, 504), allowed_methods=frozenset(['GET']))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class BlockedPageError(Exception):
+    """GoogleやAmazonがCAPTCHA・アクセス制限のページを表示した場合に送出されます。"""
+
+
+class BrowserCrashedError(Exception):
+    """ブラウザのセッションが失われた（異常終了・応答なし）場合に送出されます。"""
+
+
+class EresaLoginError(Exception):
+    """ERESAへのログインに失敗した場合に送出されます。行は書き込まずに再試行します。"""
+
+
+# セッションが失われたときにChromeDriverが返すエラーメッセージ
+DEAD_SESSION_MESSAGES = ('invalid session id', 'session deleted', 'disconnected', 'chrome not reachable',
+                         'tab crashed', 'target crashed', 'no such window', 'target window already closed',
+                         'max retries exceeded', 'connection refused')
+
+
+def is_dead_session_error(error):
+    """例外がブラウザのセッションの喪失（異常終了・応答なし）によるものかを判定します。"""
+    if isinstance(error, (InvalidSessionIdException, NoSuchWindowException)):
+        return True
+    if isinstance(error, TimeoutException):
+        return False
+    if isinstance(error, ConnectionError):
+        return True  # ChromeDriverのプロセスに接続できない
+    message = str(error).lower()
+    return any(text in message for text in DEAD_SESSION_MESSAGES)
+
+
+def rate_limit_host(url):
+    """流量制御の単位となるホスト（images.google.com → google.com、www.amazon.co.jp → amazon.co.jp）を返します。"""
+    host = (urlparse(url).hostname or '').lower()
+    parts = host.split('.')
+    if len(parts) <= 2 or all(part.isdigit() for part in parts):
+        return host
+    # co.jp などの2階層のドメインは3つ分を使う
+    size = 3 if len(parts[-1]) == 2 and parts[-2] in ('co', 'com', 'ne', 'or', 'ac', 'go') else 2
+    return '.'.join(parts[-size:])
+
+
+class HostRateController:
+    """ホストごとにトークンバケットでアクセスの間隔を、同時実行数の上限で並列数を制御します。
+
+    ブロックページを検出すると、アクセスの頻度と同時実行数を半分に下げ、一定時間そのホストへのアクセスを止めます（乗算的減少）。
+    ブロックされずに処理できるたびに、頻度と同時実行数を少しずつ上限まで戻します（加算的増加）。
+    """
+
+    def __init__(self, rate_per_second=1.0, max_concurrency=4, cooldown=60.0, max_cooldown=900.0, min_rate_per_second=0.05):
+        self.max_rate = rate_per_second  # 1秒あたりのアクセス数の上限
+        self.min_rate = min(min_rate_per_second, rate_per_second)
+        self.max_concurrency = max(1, max_concurrency)  # 同時実行数の上限
+        self.base_cooldown = cooldown  # ブロック後にアクセスを止める時間（秒）
+        self.max_cooldown = max_cooldown  # 連続してブロックされた場合の停止時間の上限（秒）
+        self.condition = threading.Condition()
+        self.hosts = {}
+
+    def _state(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = {
+                'rate': self.max_rate, 'tokens': 1.0, 'updated': time.monotonic(),
+                'limit': self.max_concurrency, 'in_flight': 0, 'successes': 0,
+                'blocked_until': 0.0, 'cooldown': self.base_cooldown,
+            }
+        return self.hosts[host]
+
+    @contextmanager
+    def acquire(self, url):
+        """アクセスできるまで待機し、with文の中の処理結果（ブロックされたかどうか）で頻度を調整します。"""
+        host = rate_limit_host(url)
+        with self.condition:
+            state = self._state(host)
+            while True:
+                now = time.monotonic()
+                state['tokens'] = min(1.0, state['tokens'] + (now - state['updated']) * state['rate'])
+                state['updated'] = now
+                wait = state['blocked_until'] - now
+                if wait <= 0 and state['in_flight'] < state['limit']:
+                    if state['tokens'] >= 1.0:
+                        break
+                    wait = (1.0 - state['tokens']) / state['rate']
+                # 同時実行数の上限に達している場合は、他のスレッドの完了通知を待つ
+                self.condition.wait(timeout=wait if wait > 0 else None)
+            state['tokens'] -= 1.0
+            state['in_flight'] += 1
+        try:
+            yield
+        except BlockedPageError:
+            self._on_blocked(host, state)
+            raise
+        else:
+            self._on_success(state)
+        finally:
+            with self.condition:
+                state['in_flight'] -= 1
+                self.condition.notify_all()
+
+    def _on_success(self, state):
+        with self.condition:
+            state['rate'] = min(self.max_rate, state['rate'] + self.max_rate / 10)
+            state['cooldown'] = self.base_cooldown
+            state['successes'] += 1
+            if state['successes'] >= state['limit']:
+                state['limit'] = min(self.max_concurrency, state['limit'] + 1)
+                state['successes'] = 0
+
+    def _on_blocked(self, host, state):
+        with self.condition:
+            now = time.monotonic()
+            if now < state['blocked_until']:
+                return  # 同じ停止期間中に他のスレッドがすでに検出している
+            state['rate'] = max(self.min_rate, state['rate'] / 2)
+            state['limit'] = max(1, state['limit'] // 2)
+            state['successes'] = 0
+            state['blocked_until'] = now + state['cooldown']
+            logger.warning(f"{host} にブロックされたため、{state['cooldown']:.0f}秒間アクセスを止めます。"
+                           f"（1秒あたり{state['rate']:.2f}回・同時{state['limit']}件に制限）")
+            state['cooldown'] = min(self.max_cooldown, state['cooldown'] * 2)
+            self.condition.notify_all()
+
+
+# eBayの商品画像が入っているdivタグのクラス（active imageを優先する）
+EBAY_ACTIVE_IMAGE_CLASS = 'ux-image-carousel-item image-treatment active image'
+EBAY_IMAGE_CLASS = 'ux-image-carousel-item image-treatment image'
+
+# リダイレクトページの検出用
+EBAY_REDIRECT_MARKER = b"Redirecting you to"
+META_TAG_PATTERN = re.compile(rb'<meta\b[^>]*>', re.IGNORECASE)
+META_REFRESH_PATTERN = re.compile(rb'http-equiv\s*=\s*["\']?refresh', re.IGNORECASE)
+META_CONTENT_PATTERN = re.compile(rb'content\s*=\s*(?:"([^"]*)"|\'([^\']*)\')', re.IGNORECASE)
+
+
+def image_url_from_attrs(attrs):
+    """imgタグの属性から画像URLを取得します。src、srcset、data-zoom-srcの順に優先します。"""
+    if 'src' in attrs:
+        return attrs['src']
+    elif 'srcset' in attrs:
+        return attrs['srcset'].split(',')[0].split(' ')[0]
+    elif 'data-zoom-src' in attrs:
+        return attrs['data-zoom-src']
+    return None
+
+
+def find_meta_refresh_url(content):
+    """HTMLのバイト列から、meta refreshタグのリダイレクト先URLを取得します。"""
+    for match in META_TAG_PATTERN.finditer(content):
+        tag = match.group(0)
+        if not META_REFRESH_PATTERN.search(tag):
+            continue
+        content_match = META_CONTENT_PATTERN.search(tag)
+        if content_match:
+            value = html.unescape((content_match.group(1) or content_match.group(2)).decode('utf-8', 'replace'))
+            if 'url=' in value:
+                return value.split('url=')[1]
+        return None
+    return None
+
+
+def extract_image_urls_with_bs4(content, encoding=None):
+    """BeautifulSoupでページ全体を解析し、(active imageのURL, imageのURL) を返します。"""
+    soup = BeautifulSoup(content, 'html.parser')
+    urls = []
+    for class_name in (EBAY_ACTIVE_IMAGE_CLASS, EBAY_IMAGE_CLASS):
+        div_tag = soup.find('div', class_=class_name)
+        img_tag = div_tag.find('img') if div_tag else None
+        urls.append(image_url_from_attrs(img_tag.attrs) if img_tag else None)
+    return tuple(urls)
+
+
+def extract_image_urls_with_selectolax(content, encoding=None):
+    """selectolax（C実装のパーサー）で解析し、(active imageのURL, imageのURL) を返します。"""
+    tree = SelectolaxHTMLParser(content)
+    urls = []
+    for class_name in (EBAY_ACTIVE_IMAGE_CLASS, EBAY_IMAGE_CLASS):
+        div_tag = tree.css_first(f'div[class="{class_name}"]')
+        img_tag = div_tag.css_first('img') if div_tag else None
+        urls.append(image_url_from_attrs(img_tag.attributes) if img_tag else None)
+    return tuple(urls)
+
+
+def extract_image_urls_with_lxml(content, encoding=None):
+    """lxml（C実装のパーサー）で解析し、(active imageのURL, imageのURL) を返します。"""
+    tree = lxml.html.fromstring(content)
+    urls = []
+    for class_name in (EBAY_ACTIVE_IMAGE_CLASS, EBAY_IMAGE_CLASS):
+        img_tags = tree.xpath(f'(//div[@class="{class_name}"])[1]/descendant::img[1]')
+        urls.append(image_url_from_attrs(img_tags[0].attrib) if img_tags else None)
+    return tuple(urls)
+
+
+class EbayCarouselScanner(HTMLParser):
+    """ページを先頭から逐次解析し、商品画像のimgタグが見つかった時点で解析を打ち切るパーサーです。"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.urls = {}  # divタグのクラス → 画像URL（最初に現れたdivタグのみ）
+        self.current_class = None  # 解析中の商品画像のdivタグのクラス
+        self.depth = 0  # 解析中のdivタグのネストの深さ
+
+    @property
+    def done(self):
+        # active imageが見つかれば、それ以降を解析する必要はない
+        return bool(self.urls.get(EBAY_ACTIVE_IMAGE_CLASS)) or len(self.urls) == 2
+
+    def handle_starttag(self, tag, attrs):
+        if self.current_class is None:
+            class_name = dict(attrs).get('class') if tag == 'div' else None
+            if class_name in (EBAY_ACTIVE_IMAGE_CLASS, EBAY_IMAGE_CLASS) and class_name not in self.urls:
+                self.current_class = class_name
+                self.depth = 1
+        elif tag == 'div':
+            self.depth += 1
+        elif tag == 'img':
+            self.urls[self.current_class] = image_url_from_attrs(dict(attrs))
+            self.current_class = None
+
+    def handle_endtag(self, tag):
+        if self.current_class is not None and tag == 'div':
+            self.depth -= 1
+            if self.depth == 0:
+                self.urls[self.current_class] = None  # divタグ内にimgタグがなかった
+                self.current_class = None
+
+
+def extract_image_urls_with_stream(content, encoding=None, chunk_size=65536):
+    """標準ライブラリのパーサーで逐次解析し、(active imageのURL, imageのURL) を返します。"""
+    text = content.decode(encoding or 'utf-8', 'replace')
+    scanner = EbayCarouselScanner()
+    for start in range(0, len(text), chunk_size):
+        scanner.feed(text[start:start + chunk_size])
+        if scanner.done:
+            break
+    return scanner.urls.get(EBAY_ACTIVE_IMAGE_CLASS), scanner.urls.get(EBAY_IMAGE_CLASS)
+
+
+# eBayのHTML解析に使用できるパーサー。EBAY_HTML_PARSERで選択します（autoは上から順に利用可能なものを使用）。
+EBAY_HTML_PARSERS = {
+    'selectolax': extract_image_urls_with_selectolax,
+    'lxml': extract_image_urls_with_lxml,
+    'stream': extract_image_urls_with_stream,
+    'bs4': extract_image_urls_with_bs4,
+}
+
+
+def select_ebay_html_parser(name='auto'):
+    """設定されたパーサー名から、eBayのHTML解析に使う関数を返します。"""
+    available = {
+        'selectolax': SelectolaxHTMLParser is not None,
+        'lxml': lxml is not None,
+        'stream': True,
+        'bs4': True,
+    }
+    if name == 'auto':
+        name = next(parser_name for parser_name in EBAY_HTML_PARSERS if available[parser_name])
+    elif not available.get(name):
+        logger.warning(f"警告: HTMLパーサー '{name}' は利用できないため、標準ライブラリの逐次解析を使用します。")
+        name = 'stream'
+    return EBAY_HTML_PARSERS[name]
+
+
+# eBayの商品ページの「商品の詳細」（Item specifics）の項目名と値
+ITEM_SPECIFICS_LABEL_MARKER = b'ux-labels-values__labels'
+ITEM_SPECIFICS_VALUE_MARKER = b'ux-labels-values__values'
+SPAN_TEXT_PATTERN = re.compile(rb'<span\b[^>]*>([^<]*)</span>', re.IGNORECASE)
+# JANコード・ASINを探す項目（上から優先）
+ITEM_CODE_LABELS = ('JAN', 'EAN', 'UPC', 'MPN', 'ASIN')
+# JANコードとして扱う項目（MPNはメーカーの型番で、数字だけでもJANコードとは限らないためASINの検索にだけ使う）
+JAN_CODE_LABELS = ('JAN', 'EAN', 'UPC')
+ASIN_PATTERN = re.compile(r'^B0[A-Z0-9]{8}$')
+AMAZON_PRODUCT_URL = "https://www.amazon.co.jp/dp/{asin}"
+
+
+def extract_item_specifics(content, encoding=None):
+    """eBayの商品ページの「商品の詳細」から、項目名 → 値 を取り出します。ページ全体を解析せず、バイト列のまま検索します。"""
+    specifics = {}
+    for block in content.split(ITEM_SPECIFICS_LABEL_MARKER)[1:]:
+        label_part, _, value_part = block.partition(ITEM_SPECIFICS_VALUE_MARKER)
+        label = SPAN_TEXT_PATTERN.search(label_part)
+        value = SPAN_TEXT_PATTERN.search(value_part)
+        if label and value:
+            label_text = html.unescape(label.group(1).decode(encoding or 'utf-8', 'replace')).strip().rstrip(':').strip()
+            value_text = html.unescape(value.group(1).decode(encoding or 'utf-8', 'replace')).strip()
+            specifics.setdefault(label_text, value_text)
+    return specifics
+
+
+def is_valid_jan_code(code):
+    """JANコード（13桁または8桁）の形式とチェックデジットを検証します。"""
+    if not re.fullmatch(r'\d{13}|\d{8}', code or ''):
+        return False
+    digits = [int(digit) for digit in code]
+    # チェックデジットの左隣から順に、3と1を交互に掛けて合計する
+    total = sum(digit * (3 if index % 2 == 0 else 1) for index, digit in enumerate(reversed(digits[:-1])))
+    return (10 - total % 10) % 10 == digits[-1]
+
+
+def resolve_item_codes(specifics):
+    """「商品の詳細」の JAN/EAN/UPC/MPN/ASIN から、JANコードとASINを取り出します。
+
+    JANコードは JAN/EAN/UPC からだけ取り出し、MPNはASINの検索にだけ使います。
+    UPC（12桁）は先頭に0を付けて13桁にします。チェックデジットが正しくない値はJANコードとして扱いません。
+    見つかったものだけを {'jan': ..., 'asin': ...} の形で返します。
+    """
+    labels = {label.upper(): value for label, value in specifics.items()}
+    codes = {}
+    for label in ITEM_CODE_LABELS:
+        for candidate in re.split(r'[\s,/]+', labels.get(label, '').upper()):
+            if label in JAN_CODE_LABELS and 'jan' not in codes:
+                digits = candidate.replace('-', '')
+                if re.fullmatch(r'\d{12}', digits):
+                    digits = '0' + digits  # UPC-A → EAN-13
+                if is_valid_jan_code(digits):
+                    codes['jan'] = digits
+            if label in ('ASIN', 'MPN') and 'asin' not in codes and ASIN_PATTERN.match(candidate):
+                codes['asin'] = candidate
+    return codes
+
+
+def get_ebay_item(ebay_url, session=None, cache=None, extract_image_urls=extract_image_urls_with_stream, metrics=None,
+                  resolve_codes=True):
+    """eBayの商品ページから画像URLを取得します。リダイレクトに対応し、指定されたクラスのdivタグから画像URLを検出し、active imageを優先します。
+
+    resolve_codesがTrueの場合は、同じページの「商品の詳細」からJANコードとASINも取り出します。
+    {'image_url': 画像URL, 'jan': JANコード, 'asin': ASIN}（見つかった項目のみ）を返し、いずれも見つからない場合はNoneを返します。
+    """
+    if cache:
+        cached_item = cache.get('ebay_image', normalize_ebay_url(ebay_url))
+        if cached_item and cached_item.startswith('{'):  # 画像URLのみの古い形式は取得し直す
+            logger.debug(f"キャッシュからeBayの商品情報を取得しました: {cached_item}")
+            return json.loads(cached_item)
 
+    http = session or requests  # セッションが渡されていれば接続を再利用する
+    try:
+        try:
+            with timed(metrics, 'ebay_fetch'):
+                response = http.get(ebay_url, timeout=20)  # タイムアウトを設定
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            logger.error(f"eBayからのリクエストエラー: {e}")
+            return None
+
+        # リダイレクトページを検出（ページ全体を解析せず、バイト列のまま検索する）
+        if EBAY_REDIRECT_MARKER in response.content:
+            logger.debug("リダイレクトページを検出しました。")
+            # リダイレクト先のURLを取得
+            redirect_url_value = find_meta_refresh_url(response.content)
+            if redirect_url_value:
                 try:
-                    print(f"リダイレクト先URLへ再度アクセスします: {redirect_url_value}")
-                    response = requests.get(redirect_url_value, timeout=20)  # リダイレクト先へアクセス
+                    logger.debug(f"リダイレクト先URLへ再度アクセスします: {redirect_url_value}")
+                    with timed(metrics, 'ebay_fetch', redirect=True):
+                        response = http.get(redirect_url_value, timeout=20)  # リダイレクト先へアクセス
                     response.raise_for_status()
-                    soup = BeautifulSoup(response.content, 'html.parser')
-
                 except requests.exceptions.RequestException as e:
-                    print(f"リダイレクト先へのリクエストエラー: {e}")
-                    return None
-                except Exception as e:
-                    print(f"リダイレクト後のBeautifulSoup解析エラー: {e}")
+                    logger.error(f"リダイレクト先へのリクエストエラー: {e}")
                     return None
             else:
-                print("リダイレクトURLを抽出できませんでした")
+                logger.debug("リダイレクトURLを抽出できませんでした")
                 return None
 
-        active_image_url = None
-        image_url = None
-
-        # image-carousel-item image-treatment active image の検索と属性の検出
-        div_tag_active = soup.find('div', class_='ux-image-carousel-item image-treatment active image')
-        if div_tag_active:
-            img_tag = div_tag_active.find('img')
-            if img_tag:
-                if 'src' in img_tag.attrs:
-                    active_image_url = img_tag['src']
-                elif 'srcset' in img_tag.attrs:
-                    srcset = img_tag['srcset']
-                    active_image_url = srcset.split(',')[0].split(' ')[0]
-                elif 'data-zoom-src' in img_tag.attrs:
-                    active_image_url = img_tag['data-zoom-src']
-
-        # image-carousel-item image-treatment image の検索と属性の検出
-        div_tag = soup.find('div', class_='ux-image-carousel-item image-treatment image')
-        if div_tag:
-            img_tag = div_tag.find('img')
-            if img_tag:
-                if 'src' in img_tag.attrs:
-                    image_url = img_tag['src']
-                elif 'srcset' in img_tag.attrs:
-                    srcset = img_tag['srcset']
-                    image_url = srcset.split(',')[0].split(' ')[0]
-                elif 'data-zoom-src' in img_tag.attrs:
-                    image_url = img_tag['data-zoom-src']
+        try:
+            with timed(metrics, 'ebay_parse'):
+                active_image_url, image_url = extract_image_urls(response.content, response.encoding)
+        except Exception as e:
+            logger.error(f"HTML解析エラー: {e}")
+            return None
 
+        item = {}
         # URLの優先順位の決定
-        if active_image_url:
-            return active_image_url
-        elif image_url:
-            return image_url
+        result_url = active_image_url or image_url
+        if result_url:
+            item['image_url'] = result_url
         else:
-            print("指定されたdivタグのいずれからも画像URLが見つかりませんでした。")
+            logger.debug("指定されたdivタグのいずれからも画像URLが見つかりませんでした。")
+
+        if resolve_codes:
+            with timed(metrics, 'ebay_item_specifics'):
+                codes = resolve_item_codes(extract_item_specifics(response.content, response.encoding))
+            if codes:
+                logger.debug(f"eBayの商品の詳細から取得しました: {codes}")
+            item.update(codes)
+
+        if not item:
             return None
+        if cache:
+            cache.set('ebay_image', normalize_ebay_url(ebay_url), json.dumps(item))
+        return item
 
     except Exception as e:
-        print(f"get_ebay_image_url関数全体でのエラー: {e}")
+        logger.error(f"get_ebay_item関数全体でのエラー: {e}")
         return None
 
 
+def get_ebay_image_url(ebay_url, session=None, cache=None, extract_image_urls=extract_image_urls_with_stream, metrics=None):
+    """eBayの商品ページから画像URLを取得します。"""
+    item = get_ebay_item(ebay_url, session, cache, extract_image_urls, metrics)
+    return item.get('image_url') if item else None
+
+
+class EbayImagePrefetcher:
+    """ブラウザの処理と並行して、eBayの商品情報（画像URL、商品の詳細のJANコード・ASIN）をスレッドプールで先読みします。"""
+
+    def __init__(self, session, max_workers=8, per_host_limit=4, lookahead=50, cache=None, extract_image_urls=extract_image_urls_with_stream, metrics=None,
+                 dedup=None, resolve_codes=True, image_index=None):
+        self.session = session
+        self.image_index = image_index  # 画像の知覚ハッシュを計算するための索引（Noneの場合は計算しない）
+        self.resolve_codes = resolve_codes  # 商品の詳細からJANコード・ASINを取り出すか
+        self.dedup = dedup  # 同じ商品のURLを1回だけ取得するための索引
+        self.metrics = metrics
+        self.cache = cache
+        self.extract_image_urls = extract_image_urls  # eBayのHTML解析に使う関数
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.per_host_limit = per_host_limit  # 同一ホストへの同時リクエスト数の上限
+        self.lookahead = max(1, lookahead)  # 何件先まで先読みするか
+        self.host_semaphores = {}
+        self.lock = threading.Lock()
+
+    def _host_semaphore(self, url):
+        """URLのホストごとの同時実行数を制限するセマフォを返します。"""
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = threading.BoundedSemaphore(self.per_host_limit)
+            return self.host_semaphores[host]
+
+    def _download(self, ebay_url):
+        with self._host_semaphore(ebay_url):
+            item = get_ebay_item(ebay_url, self.session, self.cache, self.extract_image_urls, self.metrics, self.resolve_codes)
+        # Google画像検索が必要な商品だけ、画像の知覚ハッシュを計算する
+        if self.image_index and item and item.get('image_url') and not item.get('jan') and not item.get('asin'):
+            image_url = item['image_url']
+            with self._host_semaphore(image_url):
+                fingerprint = self.image_index.fingerprint(image_url, self.session)
+            if fingerprint is not None:
+                item['image_fingerprint'] = fingerprint
+        return item
+
+    def _fetch(self, row_number, ebay_url):
+        with self.metrics.row(row_number) if self.metrics else nullcontext():
+            if self.dedup:
+                # 同じ商品の取得が処理中なら、ホストの同時実行枠を使わずに結果を待つ
+                return self.dedup.lookup('ebay_item', normalize_ebay_url(ebay_url), lambda: self._download(ebay_url))
+            return self._download(ebay_url)
+
+    def submit(self, row_number, ebay_url):
+        """商品情報の取得をスレッドプールに投入し、Futureを返します。"""
+        return self.executor.submit(self._fetch, row_number, ebay_url)
+
+    def prefetch(self, rows):
+        """(行番号, eBay URL) を先読みしながら、(行番号, eBay URL, 商品情報) を元の順番で返します。
+
+        商品情報はget_ebay_itemの戻り値で、image_indexが指定されている場合は画像の知覚ハッシュ（image_fingerprint）も含みます。
+
+        rowsの要素に3番目以降の要素（ジョブなど）がある場合は、商品情報の後ろにそのまま付けて返します。
+        """
+        pending = deque()
+        rows = iter(rows)
+        try:
+            for row_number, ebay_url, *extra in rows:
+                pending.append((row_number, ebay_url, extra, self.submit(row_number, ebay_url)))
+                if len(pending) >= self.lookahead:
+                    break
+            while pending:
+                row_number, ebay_url, extra, future = pending.popleft()
+                next_row = next(rows, None)
+                if next_row is not None:
+                    next_row_number, next_ebay_url, *next_extra = next_row
+                    pending.append((next_row_number, next_ebay_url, next_extra, self.submit(next_row_number, next_ebay_url)))
+                yield (row_number, ebay_url, future.result(), *extra)
+        finally:
+            for _, _, _, future in pending:
+                future.cancel()  # 途中で終了した場合は未着手の先読みを取り消す
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
+
+def normalize_eresa_fields(fields):
+    """ERESAの商品情報（項目名 → 値）のうち、JANコードの項目を 'JAN' として取り出します。
+
+    数字のみ、またはハイフンを含む数字列でない値はJANコードとして扱いません。
+    """
+    fields = {str(label): str(value) for label, value in fields.items()}
+    jan_code = next((value for label, value in fields.items() if 'JAN' in label and re.match(r'^([\d-]+)$', value)), None)
+    fields.pop('JAN', None)
+    if jan_code:
+        fields['JAN'] = jan_code
+    return fields
+
+
 class ChromeBrowser:
-    def __init__(self, crx_path=None, eresa_username=None, eresa_password=None):
+    def __init__(self, crx_path=None, eresa_username=None, eresa_password=None, user_data_dir=None, cache=None, stage_timeouts=None,
+                 performance_mode=False, blocked_url_patterns=None, chromedriver_path=None, eresa_session_file=None,
+                 metrics=None, dump_dir=None, max_dump_bytes=1000000, max_page_dumps=20,
+                 google_images_url=GOOGLE_IMAGES_URL, jan_extraction_mode='observer', rate_controller=None,
+                 max_navigations=500, max_memory_mb=2048, driver_cache_days=7):
         self.driver = None
+        self.max_navigations = max_navigations  # この回数のページ遷移ごとにブラウザを再起動する（0で無効）
+        self.max_memory_mb = max_memory_mb  # ブラウザのメモリ使用量がこれを超えたら再起動する（0で無効、psutilが必要）
+        self.navigation_count = 0  # 起動してからのページ遷移の回数
+        self.rate_controller = rate_controller  # ホストごとの流量制御（ワーカー間で共有）
+        self.jan_extraction_mode = jan_extraction_mode  # JANコードの取得方法（observer: 1回のスクリプト実行、polling: 要素の定期確認）
+        self.google_images_url = google_images_url  # Google画像検索のページ（ベンチマークではローカルのページを指定）
+        self.metrics = metrics  # 段階ごとの処理時間の記録
+        self.dump_dir = dump_dir  # エラー時のページソースの保存先（Noneの場合は保存しない）
+        self.max_dump_bytes = max_dump_bytes  # 保存するページソースの最大サイズ
+        self.max_page_dumps = max_page_dumps  # ページソースを保存する最大件数
+        self.page_dump_count = 0
+        self.chromedriver_path = chromedriver_path  # 固定のChromeDriverのパス
+        self.driver_cache_days = driver_cache_days  # 解決したChromeDriverのパスを再利用する日数
+        self.eresa_session_file = eresa_session_file  # ERESAのログイン状態（Cookie・localStorage）を保存するファイル
+        self.fresh_login = False  # ログインフォームからログインした直後かどうか
+        self.performance_mode = performance_mode  # ヘッドレス・リソース削減モード
+        self.blocked_url_patterns = DEFAULT_BLOCKED_URL_PATTERNS if blocked_url_patterns is None else blocked_url_patterns
+        self.stage_timeouts = stage_timeouts or dict(DEFAULT_STAGE_TIMEOUTS)  # ステージごとの待機時間の上限
+        self.cache = cache  # 画像URL→Amazon URL、ASIN→JANコードのキャッシュ
         self.crx_path = crx_path
+        self.user_data_dir = user_data_dir  # ワーカーごとのプロファイルディレクトリ
         self.logged_in_eresa = False # ERESAのログイン状態を追跡
         self.eresa_username = eresa_username
         self.eresa_password = eresa_password
@@ -167,17 +1315,227 @@ class ChromeBrowser:
     def initialize_driver(self):
         """ChromeDriverを初期化します。"""
         if not self.driver:
-            print("ChromeDriverを起動します...")
+            logger.info("ChromeDriverを起動します...")
             options = Options()
-            # options.add_argument("--headless")  # ヘッドレスモードを有効にする
+            if self.performance_mode:
+                logger.info("パフォーマンスモード（ヘッドレス・リソース削減）で起動します。")
+                options.add_argument("--headless=new")  # 拡張機能に対応した新しいヘッドレスモード
+                options.add_argument("--window-size=1280,1024")
+                options.add_argument("--disable-gpu")
+                options.add_argument("--mute-audio")
+                options.page_load_strategy = 'eager'  # DOMの構築が終わった時点で次の操作に進む
 
             if self.crx_path:
-                print(f"拡張機能（CRXファイル）を追加します: {self.crx_path}")
+                logger.debug(f"拡張機能（CRXファイル）を追加します: {self.crx_path}")
                 options.add_extension(self.crx_path)
 
-            service = Service(ChromeDriverManager().install())
-            self.driver = webdriver.Chrome(service=service, options=options)
-            print("ChromeDriverを起動しました。")
+            if self.user_data_dir:
+                logger.debug(f"プロファイルディレクトリを使用します: {self.user_data_dir}")
+                options.add_argument(f"--user-data-dir={self.user_data_dir}")
+
+            driver_path = resolve_chromedriver_path(self.chromedriver_path, self.driver_cache_days)
+            try:
+                self.driver = webdriver.Chrome(service=Service(driver_path) if driver_path else Service(), options=options)
+            except SessionNotCreatedException as e:
+                # キャッシュしたChromeDriverがChromeのバージョンと合わない場合は、解決し直して再試行する
+                logger.warning(f"ChromeDriverを起動できなかったため、バージョンを解決し直します: {e}")
+                if self.metrics:
+                    self.metrics.record_retry('driver_start', e)
+                driver_path = resolve_chromedriver_path(self.chromedriver_path, self.driver_cache_days, force_refresh=True)
+                self.driver = webdriver.Chrome(service=Service(driver_path) if driver_path else Service(), options=options)
+            self.driver.set_page_load_timeout(self.stage_timeouts['page_load'])
+            self.restore_eresa_cookies()
+            if self.performance_mode and self.blocked_url_patterns:
+                # 画像・フォント・広告などの読み込みをブロックする
+                self.driver.execute_cdp_cmd('Network.enable', {})
+                self.driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': self.blocked_url_patterns})
+                logger.debug(f"{len(self.blocked_url_patterns)}件のURLパターンの読み込みをブロックします。")
+            logger.info("ChromeDriverを起動しました。")
+
+    def load_eresa_session(self):
+        """保存されたERESAのログイン状態を読み込みます。"""
+        if not self.eresa_session_file or not os.path.exists(self.eresa_session_file):
+            return None
+        try:
+            with open(self.eresa_session_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"ERESAのログイン状態の読み込みエラー: {e}")
+            return None
+
+    def save_eresa_session(self):
+        """iframe内のERESAのCookieとlocalStorageをファイルに保存します。iframeに切り替えた状態で呼び出します。"""
+        if not self.eresa_session_file:
+            return
+        try:
+            hostname = self.driver.execute_script("return location.hostname;")
+            local_storage = self.driver.execute_script("return Object.assign({}, window.localStorage);")
+            cookies = self.driver.execute_cdp_cmd('Network.getAllCookies', {}).get('cookies', [])
+            cookies = [cookie for cookie in cookies if hostname and hostname.endswith(cookie['domain'].lstrip('.'))]
+            session = {'hostname': hostname, 'cookies': cookies, 'local_storage': local_storage, 'saved_at': time.time()}
+            temp_file = f'{self.eresa_session_file}.tmp{threading.get_ident()}'
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(session, f, ensure_ascii=False)
+            os.replace(temp_file, self.eresa_session_file)  # 書き込み途中のファイルが読まれないようにする
+            logger.info(f"ERESAのログイン状態を保存しました: {self.eresa_session_file}")
+        except Exception as e:
+            logger.error(f"ERESAのログイン状態の保存エラー: {e}")
+
+    def restore_eresa_cookies(self):
+        """保存されたERESAのCookieをブラウザに設定します。"""
+        session = self.load_eresa_session()
+        if not session or not session.get('cookies'):
+            return
+        try:
+            cookies = [{field: cookie[field] for field in CDP_COOKIE_FIELDS if field in cookie}
+                       for cookie in session['cookies']]
+            for cookie in cookies:
+                if cookie.get('expires', 0) <= 0:
+                    cookie.pop('expires', None)  # セッションCookie
+            self.driver.execute_cdp_cmd('Network.setCookies', {'cookies': cookies})
+            logger.info(f"ERESAのCookieを{len(cookies)}件復元しました。")
+        except Exception as e:
+            logger.error(f"ERESAのCookieの復元エラー: {e}")
+
+    def restore_eresa_local_storage(self):
+        """保存されたERESAのlocalStorageをiframeに設定し、iframeを再読み込みします。iframeに切り替えた状態で呼び出します。"""
+        session = self.load_eresa_session()
+        if not session or not session.get('local_storage'):
+            return False
+        try:
+            if self.driver.execute_script("return location.hostname;") != session.get('hostname'):
+                return False
+            body = self.driver.find_element(By.TAG_NAME, "body")
+            self.driver.execute_script(
+                "for (const [key, value] of Object.entries(arguments[0])) { window.localStorage.setItem(key, value); }"
+                "location.reload();",
+                session['local_storage']
+            )
+            self.wait_for('eresa_login', EC.staleness_of(body))
+            logger.debug("ERESAのlocalStorageを復元し、iframeを再読み込みしました。")
+            return True
+        except Exception as e:
+            logger.error(f"ERESAのlocalStorageの復元エラー: {e}")
+            return False
+
+    def detect_eresa_login_state(self):
+        """iframe内にログインフォームとログイン後のヘッダーのどちらが表示されるかを待ち、'logged_in' か 'login_form' を返します。"""
+        return self.wait_for('eresa_login', lambda driver: (
+            'logged_in' if driver.find_elements(By.CSS_SELECTOR, ERESA_HEADER_SELECTOR)
+            else 'login_form' if driver.find_elements(By.XPATH, ERESA_LOGIN_INPUT_XPATH)
+            else False
+        ))
+
+    def record_stage(self, stage, started):
+        """started（time.monotonic()の値）からの経過時間を段階stageの処理時間として記録します。"""
+        if self.metrics:
+            self.metrics.record_stage(stage, time.monotonic() - started)
+
+    def dump_page_source(self, label):
+        """現在のURLを記録し、ページソースを上限サイズまで別ファイルに保存します。"""
+        if not self.driver:
+            return
+        try:
+            logger.error(f"現在のURL: {self.driver.current_url}")
+            if not self.dump_dir or self.page_dump_count >= self.max_page_dumps:
+                return
+            page_source = self.driver.page_source.encode('utf-8')[:self.max_dump_bytes]
+            os.makedirs(self.dump_dir, exist_ok=True)
+            path = os.path.join(self.dump_dir, f"{time.strftime('%Y%m%d-%H%M%S')}_{threading.get_ident()}_{label}.html")
+            with open(path, 'wb') as f:
+                f.write(page_source)
+            self.page_dump_count += 1
+            logger.error(f"ページソースを保存しました: {path}")
+        except Exception:
+            logger.error("ページソースの取得に失敗しました")
+
+    def get(self, url):
+        """ページを開き、ページ遷移の回数を数えます。読み込みが終わらず、ブラウザも応答しない場合はBrowserCrashedErrorを送出します。"""
+        self.navigation_count += 1
+        try:
+            self.driver.get(url)
+        except TimeoutException:
+            try:
+                self.driver.execute_script("window.stop();")  # 読み込みを止めて、ブラウザが応答するか確認する
+            except Exception as e:
+                raise BrowserCrashedError(f"ページの読み込み中にブラウザが応答しなくなりました: {url}") from e
+            raise
+
+    def memory_usage_mb(self):
+        """ChromeDriverとChromeの全プロセスの使用メモリ（RSS）の合計をMBで返します。取得できない場合はNoneを返します。"""
+        if psutil is None or not self.driver:
+            return None
+        try:
+            process = psutil.Process(self.driver.service.process.pid)
+            processes = [process] + process.children(recursive=True)
+            total = 0
+            for child in processes:
+                try:
+                    total += child.memory_info().rss
+                except psutil.Error:
+                    pass  # 計測中に終了したプロセスは無視する
+            return total / (1024 * 1024)
+        except Exception:
+            return None
+
+    def recycle_if_needed(self):
+        """ページ遷移の回数かメモリ使用量が上限を超えていれば、ブラウザを再起動します。行の処理の合間に呼び出します。"""
+        if not self.driver:
+            return
+        if self.max_navigations and self.navigation_count >= self.max_navigations:
+            self.restart(f"ページ遷移が{self.navigation_count}回に達しました")
+            return
+        if self.max_memory_mb:
+            memory_mb = self.memory_usage_mb()
+            if memory_mb is not None and memory_mb > self.max_memory_mb:
+                self.restart(f"メモリ使用量が{memory_mb:.0f}MBに達しました")
+
+    def restart(self, reason):
+        """ブラウザを終了し、次の操作で起動し直します。ERESAのログイン状態はプロファイルと保存済みのセッションから復元されます。"""
+        logger.info(f"ブラウザを再起動します（{reason}）。")
+        if self.metrics:
+            self.metrics.record_retry('browser_restart', reason)
+        if self.driver:
+            try:
+                self.driver.quit()
+            except Exception as e:
+                logger.debug(f"ブラウザの終了時のエラー: {e}")
+            self.driver = None
+        self.navigation_count = 0
+        self.first_amazon_access = True  # 再起動後の最初のAmazonアクセスでERESAのログイン状態を確認し直す
+        self.logged_in_eresa = False
+        self.fresh_login = False
+
+    def raise_if_blocked(self):
+        """現在のページがCAPTCHAやアクセス制限のページであれば、BlockedPageErrorを送出します。"""
+        try:
+            self.driver.switch_to.default_content()  # iframe内にいる場合はページ全体を確認する
+            blocked = self.driver.execute_script(BLOCK_PAGE_SCRIPT)
+        except Exception:
+            return  # 判定できない場合は通常のエラーとして扱う
+        if blocked:
+            url = self.driver.current_url
+            logger.warning(f"アクセス制限（CAPTCHA）のページが表示されました: {url}")
+            self.dump_page_source('blocked')
+            raise BlockedPageError(url)
+
+    @contextmanager
+    def throttle(self, url):
+        """URLのホストへのアクセスを流量制御の範囲内に抑えます。"""
+        if not self.rate_controller:
+            yield
+            return
+        started = time.monotonic()
+        with self.rate_controller.acquire(url):
+            self.record_stage('rate_wait', started)
+            yield
+
+    def wait_for(self, stage, condition):
+        """ステージごとの待機時間の上限内で、条件が満たされるまで待機します。上限を超えるとTimeoutExceptionを送出します。"""
+        timeout = self.stage_timeouts[stage]
+        return WebDriverWait(self.driver, timeout, poll_frequency=0.2).until(
+            condition, message=f"{stage} の待機時間の上限（{timeout}秒）を超えました"
+        )
 
     def find_first_amazon_url(self):
         """Google画像検索の結果ページから、一番最初に現れるAmazonのURLを特定します。"""
@@ -185,217 +1543,298 @@ class ChromeBrowser:
         if search_results:
             return search_results[0].get_attribute("href")
         else:
-            print("Amazonの商品URLが見つかりませんでした。")
+            logger.debug("Amazonの商品URLが見つかりませんでした。")
             return None
 
     def search_amazon_by_image_google(self, image_url):
         """Google画像検索でAmazonの商品を探し、最も関連性の高い商品ページのURLを取得します。"""
+        if self.cache:
+            cached_amazon_url = self.cache.get('amazon_url', normalize_image_url(image_url))
+            if cached_amazon_url:
+                logger.debug(f"キャッシュからAmazonの商品URLを取得しました: {cached_amazon_url}")
+                return cached_amazon_url
+
+        with self.throttle(self.google_images_url):
+            return self._search_amazon_by_image_google(image_url)
+
+    def _search_amazon_by_image_google(self, image_url):
+        """Google画像検索を操作してAmazonの商品ページのURLを取得します。ブロックページが表示された場合はBlockedPageErrorを送出します。"""
         self.initialize_driver()  # ドライバーが未初期化なら初期化
+        search_started = time.monotonic()
         try:
-            self.driver.get("https://images.google.com/")
-            time.sleep(1)
-            print("Google画像検索ページにアクセスしました。")
+            self.get(self.google_images_url)
+            self.raise_if_blocked()
+            logger.debug("Google画像検索ページにアクセスしました。")
 
             # 画像検索ボタンをクリック
-            search_button = WebDriverWait(self.driver, 30).until(
+            search_button = self.wait_for('google_page',
                 EC.element_to_be_clickable((By.CSS_SELECTOR, '[aria-label="画像で検索"]'))
             )
             if search_button.is_displayed():
-                print("画像検索ボタンの要素を検出しました。")
+                logger.debug("画像検索ボタンの要素を検出しました。")
                 self.driver.execute_script("arguments[0].click();", search_button)
-                time.sleep(1)
-                print("画像検索ボタンをクリックしました。")
+                logger.debug("画像検索ボタンをクリックしました。")
             else:
-                print("画像検索ボタンが非表示のためクリックできませんでした")
+                logger.debug("画像検索ボタンが非表示のためクリックできませんでした")
                 return None
 
-            # 画像URLを入力
-            image_input = WebDriverWait(self.driver, 30).until(
-                EC.presence_of_element_located((By.XPATH, "//input[@class='cB9M7' and @placeholder='画像リンクを貼り付ける']"))
+            # 画像URLを入力（入力欄が表示されるまで待機）
+            image_input = self.wait_for('lens_input',
+                EC.visibility_of_element_located((By.XPATH, "//input[@class='cB9M7' and @placeholder='画像リンクを貼り付ける']"))
                 # @type='text'を削除
             )
-            if image_input.is_displayed():
-                self.driver.execute_script("arguments[0].focus();", image_input)
-                image_input.send_keys(image_url)
-                time.sleep(0.5)
-                print("画像URLを入力欄に入力しました。")
-                image_input.send_keys(Keys.ENTER)  # エンターキーを送信
-                time.sleep(2)  # エンターキー送信後の待機
-            else:
-                print("画像URLの入力欄が非表示のため、入力できませんでした。")
-                return None
+            self.driver.execute_script("arguments[0].focus();", image_input)
+            image_input.send_keys(image_url)
+            # 入力欄に画像URLが反映されるまで待機
+            self.wait_for('lens_input', lambda driver: image_input.get_attribute('value') == image_url)
+            logger.debug("画像URLを入力欄に入力しました。")
+            search_page_url = self.driver.current_url
+            image_input.send_keys(Keys.ENTER)  # エンターキーを送信
+            # 検索結果ページへ遷移するまで待機
+            self.wait_for('search_results', EC.url_changes(search_page_url))
+            self.raise_if_blocked()  # 「通常と異なるトラフィック」のページへ転送されていないか確認
 
-            # 検索結果から商品ボタンを特定
-            product_button = WebDriverWait(self.driver, 40).until(
-                EC.presence_of_element_located((By.XPATH, "//div[@role='listitem']/a/div[text()='商品']"))
+            # 検索結果から商品ボタンを特定（クリックできる状態になるまで待機）
+            product_button = self.wait_for('search_results',
+                EC.element_to_be_clickable((By.XPATH, "//div[@role='listitem']/a/div[text()='商品']"))
             )
-            if product_button.is_displayed():
-                time.sleep(1)
-                print("商品ボタンの要素を検出しました。")
-                search_button = WebDriverWait(self.driver, 30).until(
-                    EC.element_to_be_clickable((By.XPATH, "//div[@role='listitem']/a/div[text()='商品']"))
-                )
-                search_button.click()
-                time.sleep(1)
-                print("商品ボタンをクリックしました")
-            else:
-                print("商品ボタンを検出できませんでした。")
-                return None
+            logger.debug("商品ボタンの要素を検出しました。")
+            results_page_url = self.driver.current_url
+            product_button.click()
+            logger.debug("商品ボタンをクリックしました")
 
-            time.sleep(1)
+            # 商品タブへ切り替わり、Amazonのリンクが表示されるまで待機
+            try:
+                self.wait_for('product_results', lambda driver: driver.current_url != results_page_url
+                              and driver.find_elements(By.CSS_SELECTOR, "a[href*='amazon.co.jp/']"))
+            except TimeoutException:
+                logger.debug("商品タブの検索結果にAmazonのリンクが表示されませんでした。")
+                self.raise_if_blocked()
 
             # 検索結果からAmazonのリンクを探す
             amazon_url = self.find_first_amazon_url()
             if amazon_url:
+                if self.cache:
+                    self.cache.set('amazon_url', normalize_image_url(image_url), amazon_url)
                 return amazon_url
             else:
-                print("Amazonの商品URLを取得できませんでした。")
+                logger.debug("Amazonの商品URLを取得できませんでした。")
                 return None
 
+        except (BlockedPageError, BrowserCrashedError):
+            raise
         except Exception as e:
-            print(f"Google画像検索エラー: {e}")
+            if is_dead_session_error(e):
+                raise BrowserCrashedError(str(e)) from e
+            if isinstance(e, TimeoutException):
+                self.raise_if_blocked()  # 待機時間の上限を超えた原因がブロックページかどうかを確認
+            logger.error(f"Google画像検索エラー: {e}")
             return None
+        finally:
+            self.record_stage('google_search', search_started)
 
     def login_to_eresa_in_iframe(self):
          """Amazonページ内のiframeでERESAにログインします。"""
          if self.logged_in_eresa:
-             print("既にERESAにログイン済みです。")
+             logger.debug("既にERESAにログイン済みです。")
              return True
          
          try:
              
              # iframeが表示されるまで待機
-             print("iframeの表示を待機します...")
-             iframe = WebDriverWait(self.driver, 20).until(
+             logger.debug("iframeの表示を待機します...")
+             iframe = self.wait_for('eresa_iframe',
              EC.presence_of_element_located((By.XPATH, "//iframe[@data-added-by-eresa='true' and @id='eresa_chart']"))
              )
-             print("iframeが表示されました。")
+             logger.debug("iframeが表示されました。")
 
              # iframeに切り替え
-             print("iframeに切り替えます...")
+             logger.debug("iframeに切り替えます...")
              self.driver.switch_to.frame(iframe)
-             print("iframeに切り替えました。")
+             logger.debug("iframeに切り替えました。")
 
-             print("ERESAのログインページにアクセスします...")
+             logger.debug("ERESAのログインページにアクセスします...")
              
              # ページが完全にロードされるまで待機
-             print("ログインページのロードを待機します...")
-             WebDriverWait(self.driver, 20).until(EC.presence_of_element_located((By.TAG_NAME, "body")))
-             print("ログインページのロードが完了しました。")
+             logger.debug("ログインページのロードを待機します...")
+             self.wait_for('eresa_login', EC.presence_of_element_located((By.TAG_NAME, "body")))
+             logger.debug("ログインページのロードが完了しました。")
+
+             # プロファイルやCookieにログイン状態が残っている場合は、ログインフォームの代わりにヘッダーが表示される
+             login_state = self.detect_eresa_login_state()
+             if login_state == 'login_form' and self.restore_eresa_local_storage():
+                 login_state = self.detect_eresa_login_state()
+             if login_state == 'logged_in':
+                 logger.info("保存されたERESAのログイン状態を使用します。ログイン処理をスキップします。")
+                 self.logged_in_eresa = True
+                 self.driver.switch_to.default_content()
+                 return True
              
              
              # 2. ログイン情報の入力 (placeholderで要素を特定)
-             print("ユーザー名入力欄を特定します...")
-             username_input = WebDriverWait(self.driver, 20).until(
-             EC.presence_of_element_located((By.XPATH, "//input[@placeholder='メールアドレスを入力してください']"))
+             logger.debug("ユーザー名入力欄を特定します...")
+             username_input = self.wait_for('eresa_login',
+             EC.presence_of_element_located((By.XPATH, ERESA_LOGIN_INPUT_XPATH))
              )
-             print("パスワード入力欄を特定します...")
-             password_input = WebDriverWait(self.driver, 20).until(
+             logger.debug("パスワード入力欄を特定します...")
+             password_input = self.wait_for('eresa_login',
              EC.presence_of_element_located((By.XPATH, "//input[@placeholder='パスワードを入力してください']"))
              )
-             print("ユーザー名とパスワードを入力します...")
+             logger.debug("ユーザー名とパスワードを入力します...")
              username_input.send_keys(self.eresa_username)
              password_input.send_keys(self.eresa_password)
-             print("ユーザー名とパスワードを入力しました。")
+             logger.debug("ユーザー名とパスワードを入力しました。")
              
              # 3. ログインボタンのクリック (クラス名で要素を特定)
-             print("ログインボタンを特定します...")
-             login_button = WebDriverWait(self.driver, 20).until(
+             logger.debug("ログインボタンを特定します...")
+             login_button = self.wait_for('eresa_login',
              EC.element_to_be_clickable((By.CLASS_NAME, "login_button"))
              )
-             print("ログインボタンをクリックします...")
+             logger.debug("ログインボタンをクリックします...")
              login_button.click()
-             print("ログインボタンをクリックしました。")
+             logger.debug("ログインボタンをクリックしました。")
              
              # 4. ログイン後の状態の確認（例：ヘッダーの要素が表示されるまで待機）
-             print("ログイン後のヘッダー要素の表示を待機します...")
-             WebDriverWait(self.driver, 20).until(
-             EC.presence_of_element_located((By.CSS_SELECTOR, "header.header"))
+             logger.debug("ログイン後のヘッダー要素の表示を待機します...")
+             self.wait_for('eresa_login',
+             EC.presence_of_element_located((By.CSS_SELECTOR, ERESA_HEADER_SELECTOR))
              )
-             print("ログイン後のヘッダー要素が表示されました。")
+             logger.debug("ログイン後のヘッダー要素が表示されました。")
              
              self.logged_in_eresa = True  # ログイン状態を更新
+             self.fresh_login = True
+             self.save_eresa_session()  # 次回以降の実行でログインを省略できるようにする
              
              # デフォルトフレームに戻る
              self.driver.switch_to.default_content()
-             print("デフォルトフレームに戻りました。")
+             logger.debug("デフォルトフレームに戻りました。")
              
              
              return True
          
+         except (BlockedPageError, BrowserCrashedError):
+             raise
          except Exception as e:
-             print(f"iframe内のERESAログインエラー: {e}")
-             if self.driver:
-                try:
-                    print(f"現在のURL: {self.driver.current_url}")
-                    print(f"現在のページソース: {self.driver.page_source}")
-                except:
-                   print("ページソースの取得に失敗しました")
+             if is_dead_session_error(e):
+                 raise BrowserCrashedError(str(e)) from e
+             if isinstance(e, TimeoutException):
+                 self.raise_if_blocked()  # 待機時間の上限を超えた原因がブロックページかどうかを確認
+             logger.error(f"iframe内のERESAログインエラー: {e}")
+             self.dump_page_source('eresa_login')
              return False
          
     def extract_jan_code_from_amazon(self, amazon_url):
         """Amazonの商品ページからJANコードを抽出します。"""
+        fields = self.extract_eresa_fields_from_amazon(amazon_url)
+        return fields.get('JAN') if fields else None
+
+    def extract_eresa_fields_from_amazon(self, amazon_url):
+        """Amazonの商品ページに表示されたERESAの商品情報（JANコードなど、項目名 → 値）を取得します。
+
+        JANコードが取得できなかった場合はNoneを返します。ERESAへのログインに失敗した場合はEresaLoginErrorを送出します。
+        """
+        asin = extract_asin_from_amazon_url(amazon_url) if self.cache else None
+        if asin:
+            cached_jan_code = self.cache.get('jan_code', asin)
+            if cached_jan_code:
+                logger.debug(f"キャッシュからJANコードを取得しました: {cached_jan_code}")
+                return {'JAN': cached_jan_code}
+
+        with self.throttle(amazon_url):
+            fields = self._extract_eresa_fields_from_amazon(amazon_url)
+        if fields and asin:
+            self.cache.set('jan_code', asin, fields['JAN'])
+        return fields
+
+    def _extract_eresa_fields_from_amazon(self, amazon_url):
+        """Amazonの商品ページを開き、ERESAの商品情報を取得します。ブロックページが表示された場合はBlockedPageErrorを送出します。"""
         self.initialize_driver()  # ドライバーが未初期化なら初期化
 
+        iframe_started = None
         try:
-            print(f"Amazonページにアクセスします: {amazon_url}")
-            self.driver.get(amazon_url)
+            logger.debug(f"Amazonページにアクセスします: {amazon_url}")
+            load_started = time.monotonic()
+            self.get(amazon_url)
+            self.raise_if_blocked()  # ロボット確認（CAPTCHA）のページでないか確認
 
             if self.first_amazon_access and self.eresa_username and self.eresa_password:
-                print("初回アクセス時のERESAログイン処理を実行します。")
+                logger.debug("初回アクセス時のERESAログイン処理を実行します。")
                 if not self.login_to_eresa_in_iframe():
-                   print("初回アクセス時のERESAログインに失敗しました")
-                   return None
+                    # JANコードが見つからなかった行として書き込まないよう、行の処理を失敗として扱う
+                    raise EresaLoginError("初回アクセス時のERESAログインに失敗しました")
                 self.first_amazon_access = False #初回アクセスフラグをFalseにする
-                self.driver.refresh() # ログイン後、ページをリフレッシュ
-                print("ページをリフレッシュしました")
+                if self.fresh_login:
+                    # ログインフォームからログインした場合のみ、ページをリフレッシュして商品情報を表示させる
+                    self.fresh_login = False
+                    self.driver.refresh() # ログイン後、ページをリフレッシュ
+                    logger.debug("ページをリフレッシュしました")
+            self.record_stage('amazon_load', load_started)
 
                 # iframeが表示されるまで待機
-            print("iframeの表示を待機します...")
-            iframe = WebDriverWait(self.driver, 20).until(
+            iframe_started = time.monotonic()
+            logger.debug("iframeの表示を待機します...")
+            iframe = self.wait_for('eresa_iframe',
             EC.presence_of_element_located((By.XPATH, "//iframe[@data-added-by-eresa='true' and @id='eresa_chart']"))
             )
-            print("iframeが表示されました。")
+            logger.debug("iframeが表示されました。")
 
             # iframeに切り替え
-            print("iframeに切り替えます...")
+            logger.debug("iframeに切り替えます...")
             self.driver.switch_to.frame(iframe)
-            print("iframeに切り替えました。")
-
-
-            # JANコードラベルが表示されるまで待機
-            print("JANコードラベルの表示を待機します...")
-            WebDriverWait(self.driver, 20).until(
-                EC.presence_of_element_located((By.XPATH, "//div[contains(text(), 'JAN') and @class='font-weight-bold border-bottom']"))
-            )
-            print("JANコードラベルが表示されました。")
-
-            # JANコードの<span>要素と、そのテキストが特定のパターンに一致するまで待機
-            print("JANコードの要素が表示されるまで待機します...")
-            jan_code_element = WebDriverWait(self.driver, 20).until(
-                 lambda driver: self._check_jan_code_span_presence_and_pattern(driver)
-            )
-            print("JANコードの要素が表示されました。")
+            logger.debug("iframeに切り替えました。")
 
-            # JANコードを取得
-            jan_code = jan_code_element.text.strip()
-            print(f"取得したJANコード: {jan_code}")
+            if self.jan_extraction_mode == 'observer':
+                fields = self._wait_for_eresa_fields_with_observer()
+            else:
+                fields = self._wait_for_eresa_fields_with_polling()
 
             # デフォルトフレームに戻る
             self.driver.switch_to.default_content()
-            print("デフォルトフレームに戻りました。")
+            logger.debug("デフォルトフレームに戻りました。")
 
-            return jan_code
+            if not fields.get('JAN'):
+                raise TimeoutException(f"jan_code の待機時間の上限（{self.stage_timeouts['jan_code']}秒）を超えました")
+            logger.debug(f"取得したERESAの商品情報: {fields}")
+            return fields
 
+        except (BlockedPageError, BrowserCrashedError, EresaLoginError):
+            raise
         except Exception as e:
-            print(f"Amazonページエラー: {e}")
-            if self.driver:
-                try:
-                    print(f"現在のURL: {self.driver.current_url}")
-                    print(f"現在のページソース: {self.driver.page_source}")
-                except:
-                   print("ページソースの取得に失敗しました")
+            if is_dead_session_error(e):
+                raise BrowserCrashedError(str(e)) from e
+            if isinstance(e, TimeoutException):
+                self.raise_if_blocked()  # 待機時間の上限を超えた原因がブロックページかどうかを確認
+            logger.error(f"Amazonページエラー: {e}")
+            self.dump_page_source('amazon')
             return None
+        finally:
+            if iframe_started is not None:
+                self.record_stage('eresa_iframe', iframe_started)
+
+    def _wait_for_eresa_fields_with_observer(self):
+        """iframe内にスクリプトを1回だけ送り、JANコードが表示されるまでブラウザ側で待機して商品情報をまとめて受け取ります。"""
+        timeout = self.stage_timeouts['jan_code']
+        self.driver.set_script_timeout(timeout + 5)  # スクリプト側のタイムアウトより長くする
+        logger.debug("JANコードの表示をブラウザ側で待機します...")
+        fields = self.driver.execute_async_script(ERESA_FIELDS_SCRIPT, int(timeout * 1000)) or {}
+        return normalize_eresa_fields(fields)
+
+    def _wait_for_eresa_fields_with_polling(self):
+        """JANコードの要素を一定間隔で探し、表示されたらJANコードを返します（従来の方法）。"""
+        # JANコードラベルが表示されるまで待機
+        logger.debug("JANコードラベルの表示を待機します...")
+        self.wait_for('jan_code',
+            EC.presence_of_element_located((By.XPATH, "//div[contains(text(), 'JAN') and @class='font-weight-bold border-bottom']"))
+        )
+        logger.debug("JANコードラベルが表示されました。")
+
+        # JANコードの<span>要素と、そのテキストが特定のパターンに一致するまで待機
+        logger.debug("JANコードの要素が表示されるまで待機します...")
+        jan_code_element = self.wait_for('jan_code',
+             lambda driver: self._check_jan_code_span_presence_and_pattern(driver)
+        )
+        logger.debug("JANコードの要素が表示されました。")
+        return {'JAN': jan_code_element.text.strip()}
     
     def _check_jan_code_span_presence_and_pattern(self, driver):
         """JANコードの<span>要素が存在し、テキストがパターンに一致するかをチェックします。"""
@@ -421,101 +1860,666 @@ class ChromeBrowser:
 
 def extract_asin_from_amazon_url(amazon_url):
     """Amazonの商品ページURLからASINを抽出します。"""
-    print("Amazon URLからASINを抽出します...")
+    logger.debug("Amazon URLからASINを抽出します...")
     match = re.search(r'/dp/([A-Z0-9]+)', amazon_url, re.IGNORECASE)
     if match:
-        print("ASINを抽出しました")
+        logger.debug("ASINを抽出しました")
         return match.group(1)
     match = re.search(r'/product/([A-Z0-9]+)', amazon_url, re.IGNORECASE)
     if match:
-        print("ASINを抽出しました")
+        logger.debug("ASINを抽出しました")
         return match.group(1)
-    print("ASINを抽出できませんでした")
+    logger.debug("ASINを抽出できませんでした")
     return None
 
 
-def update_spreadsheet_with_jan_code(service, spreadsheet_id, sheet_name, jan_code_column, image_url_column, asin_column, amazon_url_column, row_number, jan_code, image_url, asin, amazon_url):
-    """スプレッドシートの指定された行にJANコードと関連情報を入力します。"""
+def text_cell(value):
+    """数字だけの値を、先頭の0が消えないように文字列としてスプレッドシートに書き込む形式にします。"""
+    # USER_ENTERED では 0012345678905 が数値として解釈されるため、先頭に ' を付けて文字列として入力する
+    return f"'{value}" if value and value.isdigit() else value
+
+
+def build_row_range(sheet_name, jan_code_column, amazon_url_column, row_number):
+    """JANコード列からAmazon URL列までの書き込み範囲を作成します。"""
+    # 列の設定に基づいて範囲を設定
+    start_column = jan_code_column
+    end_column = amazon_url_column if amazon_url_column else start_column
+
+    if end_column < start_column:
+        end_column = jan_code_column  # もし設定がおかしかったらJANコードの列で止める
+
+    return f'{sheet_name}!{start_column}{row_number}:{end_column}{row_number}'
+
+
+class SpreadsheetWriter:
+    """行ごとの書き込みをバッファに溜め、values().batchUpdateでまとめてスプレッドシートに書き込みます。"""
+
+    def __init__(self, service, spreadsheet_id, sheet_name, jan_code_column, image_url_column, asin_column, amazon_url_column, batch_size=50, flush_interval=30, journal=None, metrics=None,
+                 status_column=None):
+        self.service = service
+        self.status_column = status_column  # 行ごとの処理結果（失敗した理由）を書き込む列（Noneの場合は書き込まない）
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_name = sheet_name
+        self.jan_code_column = jan_code_column
+        self.image_url_column = image_url_column
+        self.asin_column = asin_column
+        self.amazon_url_column = amazon_url_column
+        self.journal = journal  # 書き込みが完了した行を記録するチェックポイント
+        self.metrics = metrics  # 書き込みにかかった時間の記録
+        self.batch_size = max(1, batch_size)  # 何行ごとに書き込むか
+        self.flush_interval = flush_interval  # 最後の書き込みから何秒経過したら書き込むか
+        self.pending = []  # 未書き込みの行データ
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add(self, row_number, jan_code, image_url, asin, amazon_url, reason=None):
+        """1行分の結果をバッファに追加し、条件を満たしたらまとめて書き込みます。
+
+        reasonは行の処理結果（found, amazon_not_found など）で、チェックポイントとSTATUS_COLUMNに記録されます。
+        """
+        cell_range = build_row_range(self.sheet_name, self.jan_code_column, self.amazon_url_column, row_number)
+        value_ranges = [{'range': cell_range, 'values': [[text_cell(jan_code), text_cell(asin), image_url, amazon_url]]}]
+        status = reason or ('found' if jan_code else 'not_found')
+        if self.status_column:
+            value_ranges.append({'range': f'{self.sheet_name}!{self.status_column}{row_number}', 'values': [[status]]})
+        with self.lock:
+            self.pending.append((row_number, status, value_ranges))
+            logger.debug(f"{row_number}行目の結果を書き込みバッファに追加しました。（未書き込み: {len(self.pending)}行）")
+            should_flush = (len(self.pending) >= self.batch_size
+                            or time.monotonic() - self.last_flush >= self.flush_interval)
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        """バッファに溜まった行をvalues().batchUpdateで書き込みます。"""
+        with self.lock:
+            if not self.pending:
+                return True
+            data = self.pending
+            self.pending = []
+            try:
+                logger.debug(f"{len(data)}行分のJANコードと関連情報をまとめて書き込みます...")
+                body = {'valueInputOption': 'USER_ENTERED',
+                        'data': [value_range for _, _, value_ranges in data for value_range in value_ranges]}
+                with SHEETS_API_LOCK, timed(self.metrics, 'sheet_write', rows=len(data)):
+                    self.service.spreadsheets().values().batchUpdate(spreadsheetId=self.spreadsheet_id, body=body).execute()
+                logger.info(f"{len(data)}行分のJANコードと関連情報を書き込みました。")
+            except Exception as e:
+                logger.error(f"スプレッドシート書き込みエラー: {e}")
+                if self.metrics:
+                    self.metrics.record_retry('sheet_write', e)
+                self.pending = data + self.pending  # 次回の書き込みで再送する
+                return False
+            finally:
+                self.last_flush = time.monotonic()
+
+            if self.journal:
+                try:
+                    self.journal.record([(row_number, status) for row_number, status, _ in data])
+                except OSError as e:
+                    logger.error(f"チェックポイントの記録エラー: {e}")
+            return True
+
+
+def resolve_chromedriver_path(pinned_path=None, max_age_days=7, force_refresh=False):
+    """ChromeDriverのパスを返します。
+
+    固定パス（CHROMEDRIVER_PATH）→ 前回解決したパスのキャッシュ → webdriver-managerによる解決の順に確認します。
+    ネットワークに接続できずに解決できない場合は、期限切れでもキャッシュ済みのパスを使用します。
+    いずれも使用できない場合はNoneを返します（Selenium Managerによる解決に任せます）。
+    """
+    global resolved_driver_path
+    with DRIVER_INSTALL_LOCK:
+        if pinned_path:
+            if os.path.exists(pinned_path):
+                return pinned_path
+            logger.warning(f"警告: CHROMEDRIVER_PATHに指定されたファイルが見つかりません: {pinned_path}")
+
+        if resolved_driver_path and not force_refresh:
+            return resolved_driver_path
+
+        cached_path, resolved_at = None, 0
+        try:
+            with open(DRIVER_PATH_CACHE_FILE, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if os.path.exists(cached.get('path', '')):
+                cached_path, resolved_at = cached['path'], cached.get('resolved_at', 0)
+        except (OSError, ValueError):
+            pass
+
+        if cached_path and not force_refresh and time.time() - resolved_at < max_age_days * 86400:
+            logger.info(f"キャッシュ済みのChromeDriverを使用します: {cached_path}")
+            resolved_driver_path = cached_path
+            return cached_path
+
+        try:
+            driver_path = ChromeDriverManager().install()
+            with open(DRIVER_PATH_CACHE_FILE, 'w', encoding='utf-8') as f:
+                json.dump({'path': driver_path, 'resolved_at': time.time()}, f)
+        except Exception as e:
+            logger.error(f"ChromeDriverのバージョン解決に失敗しました: {e}")
+            if not cached_path:
+                return None
+            logger.warning(f"オフラインのため、キャッシュ済みのChromeDriverを使用します: {cached_path}")
+            driver_path = cached_path
+        resolved_driver_path = driver_path
+        return driver_path
+
+
+JOB_REQUIRED_KEYS = ('SPREADSHEET_ID', 'SHEET_NAME', 'EBAY_LINK_COLUMN', 'START_ROW', 'END_ROW')
+# ジョブ定義ファイルで省略した場合に設定ファイル（config.ini）から引き継ぐ項目
+JOB_SETTING_KEYS = JOB_REQUIRED_KEYS + ('JAN_CODE_COLUMN', 'IMAGE_URL_COLUMN', 'ASIN_COLUMN', 'AMAZON_URL_COLUMN',
+                                        'STATUS_COLUMN', 'SKIP_FILLED_ROWS')
+
+
+def load_job_manifest(path, defaults):
+    """ジョブ定義ファイルを読み込み、(ジョブ名, 設定) のリストを返します。
+
+    セクションごとに1つのジョブ（スプレッドシート・シート・列・行の範囲）を記述します。セクションに記述していない項目は、
+    ジョブ定義ファイルの[DEFAULT]、設定ファイルの順に引き継ぎます。
+    """
+    manifest = configparser.ConfigParser(defaults={key: value for key, value in defaults.items()
+                                                   if key.upper() in JOB_SETTING_KEYS})
     try:
-        sheet = service.spreadsheets()
-        print(f"{row_number}行目にJANコードと関連情報を書き込みます...")
-        values = [[jan_code, asin, image_url, amazon_url]]
-        
-        # 列の設定に基づいて範囲を設定
-        start_column = jan_code_column
-        end_column = amazon_url_column if amazon_url_column else start_column
-        
-        if end_column < start_column:
-            end_column = jan_code_column  # もし設定がおかしかったらJANコードの列で止める
-        
-        cell_range = f'{sheet_name}!{start_column}{row_number}:{end_column}{row_number}'
-            
-        body = {'values': values}
-        sheet.values().update(spreadsheetId=spreadsheet_id, range=cell_range, valueInputOption='USER_ENTERED', body=body).execute()
-        print(f"{row_number}行目にJANコードと関連情報を書き込みました。")
-    except Exception as e:
-        print(f"スプレッドシート書き込みエラー: {e}")
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest.read_file(f)
+    except FileNotFoundError:
+        logger.error(f"エラー: ジョブ定義ファイル '{path}' が見つかりません。")
+        return None
+    except configparser.Error as e:
+        logger.error(f"エラー: ジョブ定義ファイルの読み込みに失敗しました: {e}")
+        return None
+    if not manifest.sections():
+        logger.error(f"エラー: ジョブ定義ファイル '{path}' にジョブ（セクション）がありません。")
+        return None
+    jobs = []
+    for name in manifest.sections():
+        settings = manifest[name]
+        missing = [key for key in JOB_REQUIRED_KEYS if not settings.get(key)]
+        if missing:
+            logger.error(f"エラー: ジョブ '{name}' に {', '.join(missing)} が設定されていません。")
+            return None
+        jobs.append((name, settings))
+    return jobs
+
+
+class BatchJob:
+    """1つのシートの処理（ジョブ）ごとの読み込み範囲・書き込み・進捗をまとめて管理します。
+
+    すべての行の書き込みが終わったジョブは、他のジョブの終了を待たずにスプレッドシートへ書き込み、結果をログに出力します。
+    """
+
+    PROGRESS_INTERVAL = 100  # 何行ごとに進捗をログに出力するか
+
+    def __init__(self, name, spreadsheet_id, sheet_name, ebay_link_column, start_row, end_row, writer, filled_columns=()):
+        self.name = name  # ログに表示するジョブ名（Noneの場合は表示しない）
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_name = sheet_name
+        self.ebay_link_column = ebay_link_column
+        self.start_row = start_row
+        self.end_row = end_row
+        self.writer = writer  # このジョブのシートへ書き込むSpreadsheetWriter
+        self.filled_columns = filled_columns  # 記入済みかどうかを確認する列
+        self.prefix = f"[{name}] " if name else ""
+        self.queued = 0  # 処理対象として読み込んだ行数
+        self.done = 0  # 処理が終わった行数
+        self.outcomes = Counter()  # 行の処理結果ごとの件数
+        self.reading_done = False  # シートの読み込みが終わったか
+        self.completed = False
+        self.lock = threading.Lock()
+
+    def label(self, row_number):
+        """ログに表示する行の名前を返します。"""
+        return f"{self.prefix}{row_number}行目"
+
+    def iter_targets(self, service, skip_rows=(), page_size=500, stop_at_empty_page=False):
+        """シートを読み込み、処理対象の (行番号, eBay URL, ジョブ) を順に返します。
+
+        空欄・記入済み・skip_rowsに含まれる（処理済みの）行はスキップします。
+        """
+        ebay_links = iter_ebay_links_from_spreadsheet(service, self.spreadsheet_id, self.sheet_name, self.ebay_link_column,
+                                                      self.start_row, self.end_row, self.filled_columns, page_size,
+                                                      stop_at_empty_page)
+        for row_number, ebay_url, filled in ebay_links:
+            if ebay_url and not filled and row_number not in skip_rows:
+                with self.lock:
+                    self.queued += 1
+                yield row_number, ebay_url, self
+        with self.lock:
+            self.reading_done = True
+        self._complete_if_done()
+
+    def record(self, outcome):
+        """行の処理が終わったことを記録します。"""
+        with self.lock:
+            self.done += 1
+            self.outcomes[outcome] += 1
+            report = self.done % self.PROGRESS_INTERVAL == 0
+        if report:
+            self.log_progress()
+        self._complete_if_done()
+
+    def log_progress(self):
+        with self.lock:
+            logger.info(f"{self.prefix}進捗: {self.done}行処理済み / 読み込み済み: {self.queued}行 / 結果: {dict(self.outcomes)}")
+
+    def _complete_if_done(self):
+        with self.lock:
+            if self.completed or not self.reading_done or self.done < self.queued:
+                return
+            self.completed = True
+        self.writer.flush()
+        logger.info(f"{self.prefix}すべての行の処理が完了しました。（{self.done}行 / 結果: {dict(self.outcomes)}）")
+
+
+def interleave_jobs(job_targets):
+    """ジョブごとの処理対象を1行ずつ順番に取り出し、すべてのジョブを同じ速さで進めます。"""
+    iterators = deque(iter(targets) for targets in job_targets)
+    while iterators:
+        targets = iterators.popleft()
+        target = next(targets, None)
+        if target is None:
+            continue  # 読み込みが終わったジョブは順番から外す
+        yield target
+        iterators.append(targets)
+
+
+class RowPipeline:
+    """行の処理を段階（ステージ）に分け、容量に上限のあるキューでつないで並行に処理します。
+
+    eBayの商品情報 → Google画像検索 → ERESA → 書き込み の順に行が流れ、各ステージは指定された数のスレッドで
+    それぞれの速さで処理します。下流のキューが一杯になると上流は待機するため、全体の処理速度は最も遅いステージで決まり、
+    メモリ上に溜まる行の数も一定に保たれます。行ごとの処理結果（失敗した理由）は書き込みステージまで引き継がれます。
+
+    search_browser_factoryとeresa_browser_factoryはプロファイルディレクトリ（user_data_dir）を受け取り、ChromeBrowserを返す関数です。
+    行にジョブ（BatchJob）が付いている場合は、ジョブのwriterに書き込み、ジョブの進捗を更新します。ブラウザはすべてのジョブで共有します。
+    """
+
+    # 再試行する例外 → (ログに表示する理由, 再試行しても失敗した場合の処理結果, 再試行の記録に使う段階名)
+    RETRY_REASONS = {
+        BlockedPageError: ('アクセス制限', 'blocked', 'blocked'),
+        BrowserCrashedError: ('ブラウザの異常終了', 'crashed', 'browser_crash'),
+        EresaLoginError: ('ERESAへのログインの失敗', 'login_failed', 'eresa_login'),
+    }
+
+    def __init__(self, search_browser_factory, eresa_browser_factory, writer, search_workers=1, eresa_workers=1, queue_size=None,
+                 profile_root=None, metrics=None, dedup=None, max_row_retries=3, image_index=None):
+        self.search_browser_factory = search_browser_factory
+        self.eresa_browser_factory = eresa_browser_factory
+        self.writer = writer
+        self.search_workers = max(1, search_workers)  # Google画像検索のブラウザ数
+        self.eresa_workers = max(1, eresa_workers)  # ERESAのブラウザ数
+        queue_size = queue_size or 2 * max(self.search_workers, self.eresa_workers)  # ステージ間のキューの容量
+        self.search_queue = queue.Queue(maxsize=queue_size)
+        self.eresa_queue = queue.Queue(maxsize=queue_size)
+        self.write_queue = queue.Queue(maxsize=queue_size)
+        self.profile_root = profile_root
+        self.metrics = metrics
+        self.dedup = dedup  # 同じ画像・同じASINの検索結果をステージ内で共有するための索引
+        self.max_row_retries = max_row_retries  # ブロック・ブラウザの異常終了で失敗した行を再試行する回数
+        self.image_index = image_index  # 似た画像の過去の結果を探すための索引
+        self.profile_dirs = []  # 終了時に削除する一時プロファイル
+
+    def _lookup(self, kind, key, fetch):
+        return self.dedup.lookup(kind, key, fetch) if self.dedup else fetch()
+
+    def _profile_dir(self, name):
+        # ブラウザごとにプロファイルを分け、ERESAのログイン状態が混ざらないようにする
+        if self.profile_root:
+            profile_dir = os.path.abspath(os.path.join(self.profile_root, name))
+            os.makedirs(profile_dir, exist_ok=True)
+        else:
+            profile_dir = tempfile.mkdtemp(prefix=f'eresa_{name}_')
+            self.profile_dirs.append(profile_dir)
+        return profile_dir
+
+    def _start_stage(self, stage, count, browser_factory, profile_prefix, input_queue, handler):
+        """ステージのブラウザとスレッドを起動し、スレッドのリストを返します。"""
+        retry_queue = queue.Queue()  # ブロック・ブラウザの異常終了で再試行を待つ行（ステージ内で共有）
+        threads = []
+        for worker_id in range(1, count + 1):
+            browser = browser_factory(user_data_dir=self._profile_dir(f'{profile_prefix}{worker_id}'))
+            thread = threading.Thread(target=self._browser_worker,
+                                      args=(stage, worker_id, browser, input_queue, retry_queue, handler),
+                                      name=f'{stage}-{worker_id}', daemon=True)
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def _browser_worker(self, stage, worker_id, browser, input_queue, retry_queue, handler):
+        """キューから行を取り出し、割り当てられたブラウザで処理し続けます。Noneを受け取ったら終了します。
+
+        アクセス制限（CAPTCHA）、ブラウザの異常終了、ERESAへのログインの失敗で処理できなかった行は、retry_queueへ戻して再試行します。
+        ブラウザの異常終了を検出した場合は、ブラウザを再起動してから再試行します。
+        ページ遷移の回数やメモリ使用量が上限を超えたブラウザは、行の処理の合間に再起動します。
+        """
+        finished = False  # キューから終了通知を受け取ったか
+        try:
+            while True:
+                try:
+                    task = retry_queue.get_nowait()
+                except queue.Empty:
+                    if finished:
+                        break
+                    task = input_queue.get()
+                    if task is None:
+                        finished = True  # 再試行待ちの行を処理してから終了する
+                        continue
+                browser.recycle_if_needed()
+                row_number = task['row']
+                logger.debug(f"[{stage}-{worker_id}] {task['label']}を処理します。")
+                with self.metrics.row(row_number) if self.metrics else nullcontext():
+                    try:
+                        handler(browser, task)
+                    except (BlockedPageError, BrowserCrashedError, EresaLoginError) as e:
+                        crashed = isinstance(e, BrowserCrashedError)
+                        reason, outcome, retry_stage = self.RETRY_REASONS[type(e)]
+                        if crashed:
+                            logger.warning(f"[{stage}-{worker_id}] ブラウザのセッションが失われました: {e}")
+                            browser.restart(reason)
+                        if task['attempts'] < self.max_row_retries:
+                            task['attempts'] += 1
+                            logger.warning(f"[{stage}-{worker_id}] {task['label']}は{reason}のため、後で再試行します。"
+                                           f"（{task['attempts']}/{self.max_row_retries}回目）")
+                            if self.metrics:
+                                self.metrics.record_retry(retry_stage, e)
+                            retry_queue.put(task)
+                            continue
+                        # 空欄は書き込まず、次回の実行（--resume）で処理できるようにする
+                        logger.error(f"[{stage}-{worker_id}] {task['label']}は{reason}が続いたため、処理を見送ります。")
+                        self._finish(task, outcome, write=False)
+                    except Exception as e:
+                        logger.error(f"[{stage}-{worker_id}] {task['label']}の処理中にエラーが発生しました: {e}")
+                        self._finish(task, 'error', write=False)
+        finally:
+            browser.close()
+            logger.info(f"[{stage}-{worker_id}] ブラウザを終了しました。")
+
+    def _route(self, task):
+        """eBayの商品情報をもとに、行を次のステージへ渡します。"""
+        ebay_item = task['ebay_item'] or {}
+        task['image_url'] = ebay_item.get('image_url') or ""
+        if ebay_item.get('jan'):
+            # JANコードが分かっているため、Google画像検索・ERESAは使わない
+            task['jan'] = ebay_item['jan']
+            task['asin'] = ebay_item.get('asin') or ""
+            task['amazon_url'] = AMAZON_PRODUCT_URL.format(asin=task['asin']) if task['asin'] else ""
+            logger.info(f"{task['label']}: eBayの商品の詳細からJANコードを取得しました: {task['jan']}")
+            self._finish(task, 'found_on_ebay')
+        elif ebay_item.get('asin'):
+            task['asin'] = ebay_item['asin']
+            task['amazon_url'] = AMAZON_PRODUCT_URL.format(asin=task['asin'])
+            logger.info(f"{task['label']}: eBayの商品の詳細からASINを取得したため、Google画像検索をスキップします: {task['asin']}")
+            self.eresa_queue.put(task)
+        elif task['image_url']:
+            fingerprint = ebay_item.get('image_fingerprint')
+            match = self.image_index.lookup(fingerprint) if self.image_index and fingerprint else None
+            if match:
+                # 似た画像の結果が確定済みのため、Google画像検索・ERESAは使わない
+                result, distance = match
+                task['amazon_url'] = result.get('amazon_url') or ""
+                task['asin'] = result.get('asin') or ""
+                task['jan'] = result.get('jan') or ""
+                logger.info(f"{task['label']}: 似た画像の過去の結果を再利用しました（ハミング距離: {distance}）: {task['jan']}")
+                if self.metrics:
+                    self.metrics.record_dedup('image_hash')
+                self._finish(task, 'found_by_image')
+            else:
+                self.search_queue.put(task)
+        else:
+            logger.warning(f"{task['label']}: eBayの画像URL取得に失敗しました。")
+            self._finish(task, 'image_not_found')
+
+    def _search(self, browser, task):
+        """Google画像検索でAmazonの商品ページを探し、ASINが取得できた行をERESAのステージへ渡します。"""
+        image_url = task['image_url']
+        logger.info(f"{task['label']}: eBayの画像URL: {image_url}")
+        amazon_url = self._lookup('amazon_url', normalize_image_url(image_url),
+                                  lambda: browser.search_amazon_by_image_google(image_url))
+        if not amazon_url:
+            logger.warning(f"{task['label']}: Amazonの商品URL取得に失敗しました。")
+            self._finish(task, 'amazon_not_found')
+            return
+        logger.info(f"{task['label']}: Amazonの商品URL: {amazon_url}")
+        task['amazon_url'] = amazon_url
+        task['asin'] = extract_asin_from_amazon_url(amazon_url) or ""
+        if not task['asin']:
+            logger.warning(f"{task['label']}: Amazon URLからASINを抽出できませんでした。")
+            self._finish(task, 'asin_not_found')
+            return
+        logger.info(f"{task['label']}: ASIN: {task['asin']}")
+        self.eresa_queue.put(task)
+
+    def _eresa(self, browser, task):
+        """Amazonの商品ページに表示されたERESAからJANコードを取得します。"""
+        amazon_url = task['amazon_url']
+        # JANコード以外の項目（ブランドなど）も同じ1回の取得でまとめて受け取る
+        fields = self._lookup('eresa_fields', task['asin'].upper(),
+                              lambda: browser.extract_eresa_fields_from_amazon(amazon_url)) or {}
+        logger.debug(f"{task['label']}: ERESAの商品情報: {fields}")
+        task['jan'] = fields.get('JAN') or ""
+        if task['jan']:
+            logger.info(f"{task['label']}: JANコード: {task['jan']}")
+            fingerprint = (task['ebay_item'] or {}).get('image_fingerprint')
+            if self.image_index and fingerprint:
+                self.image_index.add(fingerprint, {'amazon_url': amazon_url, 'asin': task['asin'], 'jan': task['jan']})
+            self._finish(task, 'found')
+        else:
+            logger.warning(f"{task['label']}: AmazonページでJANコードが見つかりませんでした。")
+            self._finish(task, 'jan_not_found')
+
+    def _finish(self, task, reason, write=True):
+        """行の処理結果を書き込みのステージへ渡します。"""
+        task['reason'] = reason
+        task['write'] = write
+        self.write_queue.put(task)
+
+    def _write_worker(self):
+        """処理が終わった行を書き込みバッファに追加します。スプレッドシートへの書き込みはこのスレッドだけが行います。"""
+        while True:
+            task = self.write_queue.get()
+            if task is None:
+                break
+            job = task['job']
+            writer = job.writer if job else self.writer
+            if task['write']:
+                writer.add(task['row'], task.get('jan') or "", task.get('image_url') or "", task.get('asin') or "",
+                           task.get('amazon_url') or "", task['reason'])
+            if self.metrics:
+                fields = {'job': job.name} if job and job.name else {}
+                self.metrics.record_row(task['row'], task['reason'], time.monotonic() - task['started'], **fields)
+            if job:
+                job.record(task['reason'])
+
+    def run(self, rows):
+        """(行番号, eBay URL, eBayの商品情報[, ジョブ]) を順に返すrowsを、すべての行の書き込みが終わるまで処理します。"""
+        writer_thread = threading.Thread(target=self._write_worker, name='writer', daemon=True)
+        writer_thread.start()
+        # ERESAのブラウザは従来どおり worker1, worker2, ... のプロファイルを使い、保存されたログイン状態を引き継ぐ
+        eresa_threads = self._start_stage('eresa', self.eresa_workers, self.eresa_browser_factory, 'worker',
+                                          self.eresa_queue, self._eresa)
+        search_threads = self._start_stage('search', self.search_workers, self.search_browser_factory, 'search',
+                                           self.search_queue, self._search)
+        try:
+            for row_number, ebay_url, ebay_item, *extra in rows:
+                job = extra[0] if extra else None
+                task = {'row': row_number, 'ebay_url': ebay_url, 'ebay_item': ebay_item, 'job': job,
+                        'label': job.label(row_number) if job else f"{row_number}行目",
+                        'attempts': 0, 'started': time.monotonic()}
+                self._route(task)
+        finally:
+            # 上流のステージから順に終了を通知し、処理中の行が下流へ流れ切るのを待つ
+            for threads, stage_queue in ((search_threads, self.search_queue), (eresa_threads, self.eresa_queue)):
+                for _ in threads:
+                    stage_queue.put(None)
+                for thread in threads:
+                    thread.join()
+            self.write_queue.put(None)
+            writer_thread.join()
+            for profile_dir in self.profile_dirs:
+                shutil.rmtree(profile_dir, ignore_errors=True)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="eBayの商品画像からJANコードを取得し、スプレッドシートに書き込みます。")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Google画像検索・ERESAそれぞれに並列に起動するChromeブラウザの数。起動するChromeは合計でこの2倍になります（省略時は設定ファイルのWORKERS、未設定なら1）")
+    parser.add_argument('--resume', action='store_true',
+                        help="チェックポイントに記録された行をスキップし、前回中断したところから処理を再開します")
+    parser.add_argument('--jobs', default=None,
+                        help="複数のシートをまとめて処理するジョブ定義ファイル（省略時は設定ファイルのJOBS_FILE、未設定なら設定ファイルのシートのみ）")
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default=None,
+                        help="ログの出力レベル（省略時は設定ファイルのLOG_LEVEL、未設定ならINFO）")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s [%(threadName)s] %(message)s')
+    logger.setLevel(args.log_level or logging.INFO)
+
     config = load_config()
     if not config:
-        print("設定ファイルの読み込みに失敗しました。")
+        logger.error("設定ファイルの読み込みに失敗しました。")
         exit()
     credentials_file = config['CREDENTIALS_FILE']
-    spreadsheet_id = config['SPREADSHEET_ID']
-    sheet_name = config['SHEET_NAME']
-    ebay_link_column = config['EBAY_LINK_COLUMN']
-    jan_code_column = config.get('JAN_CODE_COLUMN')
-    start_row = int(config.get('START_ROW'))
-    end_row = int(config.get('END_ROW'))
-    image_url_column = config.get('IMAGE_URL_COLUMN')
-    asin_column = config.get('ASIN_COLUMN')
-    amazon_url_column = config.get('AMAZON_URL_COLUMN')
+    jobs_file = args.jobs or config.get('JOBS_FILE', fallback='')  # 複数のシートをまとめて処理するジョブ定義ファイル
+    if jobs_file:
+        job_settings = load_job_manifest(jobs_file, config)
+        if not job_settings:
+            logger.error("ジョブ定義ファイルの読み込みに失敗しました。")
+            exit()
+        logger.info(f"ジョブ定義ファイルから{len(job_settings)}件のジョブを読み込みました。")
+    else:
+        job_settings = [(None, config)]  # 設定ファイルのシートだけを処理する
     crx_path = config.get('CRX_PATH')  # CRXファイルのパスを追加
     eresa_username = config.get('ERESA_USERNAME')
     eresa_password = config.get('ERESA_PASSWORD')
+    write_batch_size = int(config.get('WRITE_BATCH_SIZE', fallback=50))  # 何行ごとにまとめて書き込むか
+    write_flush_interval = float(config.get('WRITE_FLUSH_INTERVAL', fallback=30))  # 何秒ごとに書き込むか
+    ebay_fetch_workers = int(config.get('EBAY_FETCH_WORKERS', fallback=8))  # eBay先読みのスレッド数
+    ebay_per_host_limit = int(config.get('EBAY_PER_HOST_LIMIT', fallback=4))  # 同一ホストへの同時リクエスト数
+    ebay_prefetch_ahead = int(config.get('EBAY_PREFETCH_AHEAD', fallback=50))  # 何件先まで先読みするか
+    ebay_max_retries = int(config.get('EBAY_MAX_RETRIES', fallback=3))  # eBayへのリクエストの再試行回数
+    workers = args.workers if args.workers is not None else int(config.get('WORKERS', fallback=1))  # ブラウザの並列数
+    cache_file = config.get('CACHE_FILE', fallback='cache.sqlite3')  # 空欄にするとキャッシュを使用しない
+    cache_ttl_seconds = {
+        'ebay_image': float(config.get('CACHE_TTL_DAYS_EBAY_IMAGE', fallback=7)) * 86400,
+        'amazon_url': float(config.get('CACHE_TTL_DAYS_AMAZON_URL', fallback=30)) * 86400,
+        'jan_code': float(config.get('CACHE_TTL_DAYS_JAN_CODE', fallback=365)) * 86400,
+        'image_hash': float(config.get('CACHE_TTL_DAYS_IMAGE_HASH', fallback=30)) * 86400,
+    }
+    cache_max_entries = int(config.get('CACHE_MAX_ENTRIES', fallback=100000))  # tierごとの最大件数
+    stage_timeouts = parse_stage_timeouts(config.get('STAGE_TIMEOUTS', fallback=''))  # ステージごとの待機時間の上限
+    checkpoint_file = config.get('CHECKPOINT_FILE', fallback='checkpoint.jsonl')  # 行ごとの処理状況の記録
+    read_page_size = int(config.get('READ_PAGE_SIZE', fallback=500))  # スプレッドシートから一度に読み込む行数
+    stop_at_empty_page = config.getboolean('STOP_AT_EMPTY_PAGE', fallback=False)  # eBayリンクが1件もないページで読み込みを終えるか
+    ebay_html_parser = config.get('EBAY_HTML_PARSER', fallback='auto')  # eBayのHTML解析に使うパーサー
+    performance_mode = config.getboolean('PERFORMANCE_MODE', fallback=False)  # ヘッドレス・リソース削減モード
+    blocked_url_patterns = config.get('BLOCKED_URL_PATTERNS', fallback='')  # 空欄の場合は既定のパターンを使用
+    blocked_url_patterns = [pattern.strip() for pattern in blocked_url_patterns.split(',') if pattern.strip()] or None
+    profile_root = config.get('PROFILE_DIR', fallback='')  # 空欄の場合は一時プロファイルを使用
+    chromedriver_path = config.get('CHROMEDRIVER_PATH', fallback='')  # 空欄の場合は自動で解決
+    driver_cache_days = float(config.get('DRIVER_CACHE_DAYS', fallback=7))  # 解決したChromeDriverのパスを再利用する日数
+    eresa_session_file = config.get('ERESA_SESSION_FILE', fallback='eresa_session.json')  # ERESAのログイン状態の保存先
+    if not args.log_level:
+        logger.setLevel(config.get('LOG_LEVEL', fallback='INFO').upper())
+    metrics_file = config.get('METRICS_FILE', fallback='metrics.jsonl')  # 段階ごとの処理時間の記録先
+    dump_dir = config.get('PAGE_DUMP_DIR', fallback='page_dumps')  # エラー時のページソースの保存先
+    max_dump_bytes = int(config.get('PAGE_DUMP_MAX_BYTES', fallback=1000000))  # 保存するページソースの最大サイズ
+    max_page_dumps = int(config.get('PAGE_DUMP_LIMIT', fallback=20))  # ブラウザごとに保存するページソースの最大件数
+    dedup_rows = config.getboolean('DEDUP_ROWS', fallback=True)  # 同じ商品・同じ画像の行の検索結果を再利用するか
+    ebay_item_codes = config.getboolean('EBAY_ITEM_CODES', fallback=True)  # eBayの商品の詳細のJANコード・ASINを使うか
+    host_rate_per_second = float(config.get('HOST_RATE_PER_SECOND', fallback=1.0))  # Google・Amazonへの1秒あたりのアクセス数の上限
+    host_max_concurrency = int(config.get('HOST_MAX_CONCURRENCY', fallback=workers))  # Google・Amazonへの同時アクセス数の上限
+    block_cooldown = float(config.get('BLOCK_COOLDOWN_SECONDS', fallback=60))  # ブロックされた後にアクセスを止める時間
+    # --workersが指定された場合は、Google画像検索・ERESAのどちらのブラウザ数にも使用する
+    search_workers = args.workers if args.workers is not None else int(config.get('SEARCH_WORKERS', fallback='') or workers)  # Google画像検索のブラウザ数（空欄はWORKERSと同じ）
+    eresa_workers = args.workers if args.workers is not None else int(config.get('ERESA_WORKERS', fallback='') or workers)  # ERESAのブラウザ数（空欄はWORKERSと同じ）
+    pipeline_queue_size = int(config.get('PIPELINE_QUEUE_SIZE', fallback=0))  # ステージ間のキューの容量（0でブラウザ数の2倍）
+    block_retry_limit = int(config.get('BLOCK_RETRY_LIMIT', fallback=3))  # ブロック・ブラウザの異常終了で失敗した行を再試行する回数
+    browser_max_navigations = int(config.get('BROWSER_MAX_NAVIGATIONS', fallback=500))  # ブラウザを再起動するページ遷移の回数
+    browser_max_memory_mb = float(config.get('BROWSER_MAX_MEMORY_MB', fallback=2048))  # ブラウザを再起動するメモリ使用量
+    if browser_max_memory_mb and psutil is None:
+        logger.info("psutilがインストールされていないため、ブラウザのメモリ使用量は監視しません。")
+    image_hash_index = config.getboolean('IMAGE_HASH_INDEX', fallback=False)  # 似た画像の過去の結果を再利用するか
+    image_hash_threshold = int(config.get('IMAGE_HASH_THRESHOLD', fallback=5))  # 同じ画像とみなすハミング距離の上限
+    if image_hash_index and Image is None:
+        logger.info("Pillowがインストールされていないため、似た画像の過去の結果は再利用しません。")
+        image_hash_index = False
+    jan_extraction_mode = config.get('JAN_EXTRACTION_MODE', fallback='observer').lower()  # JANコードの取得方法
+    if jan_extraction_mode not in JAN_EXTRACTION_MODES:
+        logger.warning(f"警告: JAN_EXTRACTION_MODE '{jan_extraction_mode}' は不明なため、observerを使用します。")
+        jan_extraction_mode = 'observer'
 
-    sheets_service = authenticate_sheets_api(credentials_file)
+    sheets_service = authenticate_sheets_api(credentials_file)  # すべてのジョブで共有する
     if sheets_service:
-        ebay_links = get_ebay_links_from_spreadsheet(sheets_service, spreadsheet_id, sheet_name, ebay_link_column, start_row)
-        if ebay_links:
-            browser = ChromeBrowser(crx_path, eresa_username, eresa_password)  # クラスのインスタンスを作成、crx_path, ユーザー名、パスワードを渡す
-            row_number = start_row  # 書き込み開始行を初期化
-            try:
-                for ebay_url in ebay_links:
-                    if row_number > end_row:
-                        print(f"指定された終了行 {end_row} に到達したため、処理を終了します。")
-                        break  # 終了行に達したらループを中断
-                    image_url = get_ebay_image_url(ebay_url)
-                    if image_url:
-                        print(f"eBayの画像URL: {image_url}")
-                        amazon_url = browser.search_amazon_by_image_google(image_url)
-                        if amazon_url:
-                            print(f"Amazonの商品URL: {amazon_url}")
-                            asin = extract_asin_from_amazon_url(amazon_url)
-                            if asin:
-                                print(f"ASIN: {asin}")
-                                jan_code = browser.extract_jan_code_from_amazon(amazon_url)
-                                if jan_code:
-                                    print(f"JANコード: {jan_code}")
-                                    update_spreadsheet_with_jan_code(sheets_service, spreadsheet_id, sheet_name, jan_code_column, image_url_column, asin_column, amazon_url_column, row_number, jan_code, image_url, asin, amazon_url)
-                                else:
-                                    print("AmazonページでJANコードが見つかりませんでした。")
-                                    update_spreadsheet_with_jan_code(sheets_service, spreadsheet_id, sheet_name, jan_code_column, image_url_column, asin_column, amazon_url_column, row_number, "", image_url, asin, amazon_url)
-                            else:
-                                print("Amazon URLからASINを抽出できませんでした。")
-                                update_spreadsheet_with_jan_code(sheets_service, spreadsheet_id, sheet_name, jan_code_column, image_url_column, asin_column, amazon_url_column, row_number, "", image_url, asin, amazon_url)
-                        else:
-                            print("Amazonの商品URL取得に失敗しました。")
-                            update_spreadsheet_with_jan_code(sheets_service, spreadsheet_id, sheet_name, jan_code_column, image_url_column, asin_column, amazon_url_column, row_number, "", image_url, "", "")
-                    else:
-                        print(f"eBayの画像URL取得に失敗しました。")
-                        update_spreadsheet_with_jan_code(sheets_service, spreadsheet_id, sheet_name, jan_code_column, image_url_column, asin_column, amazon_url_column, row_number, "", "", "", "",)
-                    row_number += 1  # 次の行へ
-            finally:
-                browser.close()
-        else:
-            print("eBayリンクの取得に失敗しました。")
+        metrics = RunMetrics(metrics_file or None)
+        jobs = []
+        job_targets = []
+        for job_name, settings in job_settings:
+            spreadsheet_id = settings['SPREADSHEET_ID']
+            sheet_name = settings['SHEET_NAME']
+            jan_code_column = settings.get('JAN_CODE_COLUMN')
+            asin_column = settings.get('ASIN_COLUMN')
+            status_column = settings.get('STATUS_COLUMN', fallback='')  # 行ごとの処理結果を書き込む列（空欄で書き込まない）
+            skip_filled_rows = settings.getboolean('SKIP_FILLED_ROWS', fallback=False)  # JANコードかASINが記入済みの行をスキップするか
+            journal = CheckpointJournal(checkpoint_file, spreadsheet_id, sheet_name, job_name)
+            writer = SpreadsheetWriter(sheets_service, spreadsheet_id, sheet_name, jan_code_column, settings.get('IMAGE_URL_COLUMN'), asin_column, settings.get('AMAZON_URL_COLUMN'), write_batch_size, write_flush_interval, journal, metrics,
+                                       status_column or None)
+            filled_columns = (jan_code_column, asin_column) if skip_filled_rows else ()
+            job = BatchJob(job_name, spreadsheet_id, sheet_name, settings['EBAY_LINK_COLUMN'], int(settings.get('START_ROW')),
+                           int(settings.get('END_ROW')), writer, filled_columns)
+            if args.resume:
+                done_rows = journal.load()
+                logger.info(f"{job.prefix}チェックポイントから{len(done_rows)}行分の処理済みの行を読み込みました。")
+            else:
+                journal.reset()
+                done_rows = {}
+            jobs.append(job)
+            # 空欄・記入済み・処理済みの行はスキップする（行番号はシート上の位置のまま保持される）
+            job_targets.append(job.iter_targets(sheets_service, done_rows, read_page_size, stop_at_empty_page))
+        # 複数のジョブの行を1行ずつ交互に流し、共有のブラウザで公平に処理する
+        targets = interleave_jobs(job_targets)
+        cache = ResultCache(cache_file, cache_ttl_seconds, cache_max_entries) if cache_file else None
+        dedup = RunDedupIndex(metrics) if dedup_rows else None
+        rate_controller = HostRateController(host_rate_per_second, host_max_concurrency, block_cooldown)
+        image_index = ImageHashIndex(cache, image_hash_threshold, metrics) if image_hash_index else None
+        session = create_http_session(pool_size=ebay_fetch_workers, max_retries=ebay_max_retries)
+        prefetcher = EbayImagePrefetcher(session, ebay_fetch_workers, ebay_per_host_limit, ebay_prefetch_ahead, cache,
+                                         select_ebay_html_parser(ebay_html_parser), metrics, dedup, ebay_item_codes,
+                                         image_index)
+        read_failed = False
+        try:
+            rows = prefetcher.prefetch(targets)
+            browser_options = dict(cache=cache, stage_timeouts=stage_timeouts,
+                                   performance_mode=performance_mode, blocked_url_patterns=blocked_url_patterns,
+                                   chromedriver_path=chromedriver_path or None, metrics=metrics, dump_dir=dump_dir or None,
+                                   max_dump_bytes=max_dump_bytes, max_page_dumps=max_page_dumps,
+                                   rate_controller=rate_controller, max_navigations=browser_max_navigations,
+                                   max_memory_mb=browser_max_memory_mb, driver_cache_days=driver_cache_days)
+            # Google画像検索のブラウザにはERESAの拡張機能を読み込まない
+            search_browser_factory = functools.partial(ChromeBrowser, **browser_options)
+            eresa_browser_factory = functools.partial(ChromeBrowser, crx_path, eresa_username, eresa_password,
+                                                      eresa_session_file=eresa_session_file or None,
+                                                      jan_extraction_mode=jan_extraction_mode, **browser_options)
+            # ブラウザを起動する前にChromeDriverのパスを解決しておく
+            resolve_chromedriver_path(chromedriver_path or None, driver_cache_days)
+            # 書き込み先は行ごとのジョブのwriterを使う
+            pipeline = RowPipeline(search_browser_factory, eresa_browser_factory, None, search_workers, eresa_workers,
+                                   pipeline_queue_size, profile_root, metrics, dedup, block_retry_limit, image_index)
+            pipeline.run(rows)
+        except SpreadsheetReadError as e:
+            # 読み込めなかった行以降は処理していないため、正常終了として扱わない
+            logger.error(f"{e} 処理を中断しました。書き込みが完了した行はチェックポイントに記録されているため、--resumeで再開できます。")
+            read_failed = True
+        finally:
+            for job in jobs:
+                job.writer.flush()  # 未書き込みの行を書き込む
+                if job.name and not job.completed:
+                    job.log_progress()  # 途中で終了したジョブの進捗を出力する
+            prefetcher.close()
+            if cache:
+                cache.close()
+            metrics.close()  # 段階ごとの処理時間の集計を出力する
+        if read_failed:
+            exit(1)
     else:
-        print("API認証に失敗しました")
\ No newline at end of file
+        logger.error("API認証に失敗しました")
\ No newline at end of file